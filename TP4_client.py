@@ -3,9 +3,11 @@ import email
 import email.message
 import getpass
 import json
+import queue
 import re
 import socket
-from typing import NoReturn
+import threading
+from typing import NoReturn, Optional
 
 import glosocket
 import TP4_utils
@@ -22,6 +24,9 @@ class Client:
             l’authentification avec le serveur.
         - Préparer un attribut «_username» pour garder en mémoire le nom
             d’utilisateur utilisé pour l’authentification.
+        - Préparer la file des réponses du serveur, utilisée une fois le
+            client abonné aux notifications de nouveaux courriels.
+        - Préparer la copie locale des dossiers consultés.
 
         Attention: ne changez pas le nom des attributs fournis, ils sont utilisés dans les tests.
         Vous pouvez cependant ajouter des attributs supplémentaires.
@@ -33,6 +38,10 @@ class Client:
         soc.connect((destination, TP4_utils.SOCKET_PORT))
 
         self.socket_client = soc
+        self._responses: Optional[queue.Queue] = None
+        # Copie locale des dossiers : époque, séquence de modification et
+        # sujets (avec leur état de lecture) par numéro de courriel
+        self._inbox_cache: dict[str, dict] = {}
 
     def _recv_data(self) -> TP4_utils.GLO_message:
         """
@@ -42,8 +51,14 @@ class Client:
         Le message attendu est une chaine de caractère représentant un GLO_message
         valide, qui est décodé avec le module json. Si le JSON est invalide
         ou le résultat est None, le programme termine avec un code-1.
+
+        Une fois le client abonné aux notifications, les réponses sont lues
+        dans la file alimentée par le fil d’écoute.
         """
-        message = glosocket.recv_msg(self.socket_client)
+        if self._responses is not None:
+            message = self._responses.get()
+        else:
+            message = glosocket.recv_msg(self.socket_client)
         try:
             message = json.loads(message)
             if message["header"] is None or message["data"] is None:
@@ -56,6 +71,51 @@ class Client:
             data=message["data"]
         )
 
+    def _subscribe(self) -> None:
+        """
+        Cette fonction abonne le client aux notifications de nouveaux courriels.
+
+        Si le serveur accepte l’abonnement, un fil d’écoute est démarré : il
+        affiche les notifications dès leur arrivée et transmet les autres
+        messages à _recv_data par la file des réponses.
+        """
+        glosocket.send_msg(self.socket_client, json.dumps({
+            "header": TP4_utils.message_header.INBOX_SUBSCRIBE,
+            "data": {"username": self._username}
+        }))
+
+        message = self._recv_data()
+        if message["header"] == TP4_utils.message_header.ERROR:
+            return
+
+        self._responses = queue.Queue()
+        threading.Thread(target=self._listen, daemon=True).start()
+
+    def _listen(self) -> None:
+        """
+        Boucle du fil d’écoute des messages du serveur.
+        """
+        while True:
+            try:
+                message = glosocket.recv_msg(self.socket_client)
+            except OSError:
+                message = None
+            if message is None:
+                self._responses.put(None)
+                return
+
+            try:
+                decoded = json.loads(message)
+                is_notification = decoded["header"] == \
+                    TP4_utils.message_header.NEW_EMAIL_NOTIFICATION
+            except (json.JSONDecodeError, TypeError, KeyError):
+                is_notification = False
+
+            if is_notification:
+                print(TP4_utils.NEW_EMAIL_DISPLAY.format(**decoded["data"]))
+            else:
+                self._responses.put(message)
+
     def _authentication(self) -> None:
         """
         Cette fonction traite l’authentification du client.
@@ -120,39 +180,42 @@ class Client:
         Cette fonction traite les requêtes de consultation de courriel.
 
         La fonction, dans l’ordre:
-        - Envoie une requête au serveur de consultation de courriel.
-        - Récupère la liste des sujets depuis le serveur.
+        - Synchronise la copie locale du dossier avec le serveur.
         - Demande à l’utilisateur quel courriel consulter.
         - Transmet ce choix au serveur.
         - Récupère le courriel choisi depuis le serveur.
         - Affiche le courriel dans le terminal avec le gabarit EMAIL_DISPLAY.
+        - Propose les actions possibles sur ce courriel.
         """
-        glosocket.send_msg(self.socket_client, json.dumps({
-            "header": TP4_utils.message_header.INBOX_READING_REQUEST,
-            "data": {"username": self._username}
-        }))
-
-        message = self._recv_data()
-        if message["header"] == TP4_utils.message_header.ERROR:
+        dossier: str = input(
+            f"Entrez le dossier à consulter ({TP4_utils.DEFAULT_FOLDER} par défaut) : ").strip()
+        dossier = dossier or TP4_utils.DEFAULT_FOLDER
+        entries = self._sync_folder(dossier)
+        if entries is None:
             print("\nErreur lors de la récupération des courriels.\n")
             return
-        elif not len(message["data"]["subjects"]):
+        elif not len(entries):
             print("\nIl y a aucun courriels.\n")
             return
 
         print("\nListe des sujets: ")
-        for subject in message["data"]["subjects"]:
+        for number in sorted(entries):
+            subject, unread = entries[number]
+            if unread:
+                subject += TP4_utils.UNREAD_MARKER
             print(subject)
 
         choix: str = input(
             "Entrez le numéro du courriel que vous voulez consulter: ")
-        if re.search(r"^[0-9]$", choix) is None:
+        if re.search(r"^[0-9]+$", choix) is None:
             print("\nErreur lors du choix des courriels disponibles.\n")
             return
 
+        # L'époque garantit que le numéro désigne le courriel de la liste affichée
+        epoch = self._inbox_cache[dossier]["epoch"]
         glosocket.send_msg(self.socket_client, json.dumps({
             "header": TP4_utils.message_header.INBOX_READING_CHOICE,
-            "data": {"username": self._username, "choice": choix}
+            "data": {"username": self._username, "choice": choix, "epoch": epoch}
         }))
 
         message = self._recv_data()
@@ -161,8 +224,70 @@ class Client:
             return
 
         print("\n" + TP4_utils.EMAIL_DISPLAY.format(**message["data"]))
+        self._email_action(choix, epoch)
         return
 
+    def _sync_folder(self, folder: str) -> Optional[dict[int, tuple[str, bool]]]:
+        """
+        Cette fonction synchronise la copie locale d’un dossier.
+
+        La fonction envoie au serveur l’époque et la séquence de modification
+        de la dernière synchronisation, puis applique à la copie locale les
+        changements reçus. Retourne les sujets du dossier, ou None en cas
+        d’erreur.
+        """
+        cache = self._inbox_cache.get(folder, {"epoch": None, "modseq": -1, "entries": {}})
+        glosocket.send_msg(self.socket_client, json.dumps({
+            "header": TP4_utils.message_header.INBOX_SYNC_REQUEST,
+            "data": {"username": self._username, "folder": folder,
+                     "epoch": cache["epoch"], "modseq": cache["modseq"]}
+        }))
+
+        message = self._recv_data()
+        if message["header"] == TP4_utils.message_header.ERROR:
+            return None
+
+        data = message["data"]
+        if not data["not_modified"]:
+            entries = {} if data["full"] else cache["entries"]
+            for number in data["removed"]:
+                entries.pop(number, None)
+            for entry in data["entries"]:
+                entries[entry["number"]] = (entry["subject"], entry["unread"])
+            cache = {"epoch": data["epoch"], "modseq": data["modseq"], "entries": entries}
+            self._inbox_cache[folder] = cache
+        return cache["entries"]
+
+    def _email_action(self, choix: str, epoch: str) -> None:
+        """
+        Cette fonction propose les actions possibles sur un courriel consulté.
+
+        La fonction, dans l’ordre:
+        - Demande à l’utilisateur l’action à effectuer (supprimer, marquer
+            comme non lu, déplacer ou retour).
+        - Transmet la requête correspondante au serveur.
+        - Affiche la réponse du serveur.
+        """
+        action: str = input(TP4_utils.CLIENT_EMAIL_ACTION_CHOICE + "\n")
+        data = {"username": self._username, "choice": choix, "epoch": epoch}
+        if action == "1":
+            header = TP4_utils.message_header.EMAIL_DELETE
+        elif action == "2":
+            header = TP4_utils.message_header.EMAIL_MARK_UNREAD
+        elif action == "3":
+            header = TP4_utils.message_header.EMAIL_MOVE
+            data["folder"] = input("Entrez le nom du dossier : ").strip()
+        else:
+            return
+
+        glosocket.send_msg(self.socket_client, json.dumps({
+            "header": header,
+            "data": data
+        }))
+
+        message = self._recv_data()
+        print("\n" + message["data"])
+
     def _sending(self) -> None:
         """
         Cette fonction traite les requêtes d’envoi de courriel.
@@ -231,11 +356,13 @@ class Client:
     def run(self) -> NoReturn:
         """
         Appelle la fonction _athentication en boucle jusqu’à la connexion.
-        Une fois connecté, appelle la fonction _main_loop en boucle jusqu’à
-        la fin du programme.
+        Une fois connecté, s’abonne aux notifications de nouveaux courriels
+        puis appelle la fonction _main_loop en boucle jusqu’à la fin du
+        programme.
         """
         while not self._logged_in:
             self._authentication()
+        self._subscribe()
         while True:
             self._main_loop()
 
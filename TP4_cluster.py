@@ -0,0 +1,256 @@
+"""\
+Module fournissant le mode grappe du serveur courriel.
+
+Les utilisateurs sont répartis entre plusieurs nœuds par hachage cohérent
+de leur nom d’utilisateur. La configuration de la grappe est un fichier
+JSON de la forme:
+{
+    "secret": "<secret partagé entre les nœuds>",
+    "nodes": {"node1": ["127.0.0.1", 5401], "node2": ["127.0.0.1", 5402]},
+    "joining": {"node3": ["127.0.0.1", 5403]}
+}
+
+Les nœuds de «joining», facultatif, sont en cours d’ajout : les sessions et
+les courriels restent dirigés vers les nœuds de «nodes» jusqu’à ce que
+l’outil de rééquilibrage leur ait transféré leurs utilisateurs, puis les
+ajoute à «nodes».
+
+Le module fournit aussi la file d’envoi (outbox) des courriels destinés
+aux utilisateurs d’un autre nœud et l’outil de rééquilibrage:
+python3 TP4_cluster.py cluster.json
+"""
+import argparse
+import bisect
+import hashlib
+import json
+import os
+import re
+import socket
+import time
+from typing import Iterator, NoReturn, Optional
+
+import glosocket
+import TP4_utils
+
+
+def _hash(key: str) -> int:
+    # hash() varie d'un processus à l'autre, le hachage doit être stable
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+
+    def __init__(self, nodes: list[str], vnodes: int = TP4_utils.CLUSTER_VNODES) -> None:
+        """
+        Prépare l’anneau de hachage cohérent. Chaque nœud y occupe «vnodes»
+        positions pour répartir les utilisateurs uniformément; l’ajout d’un
+        nœud ne déplace donc que les utilisateurs qui lui reviennent.
+        """
+        self._ring = sorted((_hash(f"{node}#{index}"), node)
+                            for node in nodes for index in range(vnodes))
+        self._keys = [key for key, _ in self._ring]
+
+    def node_for(self, username: str) -> str:
+        index = bisect.bisect(self._keys, _hash(username)) % len(self._keys)
+        return self._ring[index][1]
+
+
+class ClusterConfig:
+
+    def __init__(self, path: str) -> None:
+        """
+        Charge la configuration de la grappe depuis le fichier JSON «path».
+        """
+        self.path = os.path.abspath(path)
+        with open(self.path, "r") as f:
+            config = json.load(f)
+        self.mtime = os.path.getmtime(self.path)
+        self.secret: str = config["secret"]
+        # Adresses de tous les nœuds, y compris ceux en cours d'ajout
+        self.nodes: dict[str, tuple[str, int]] = {
+            name: (host, int(port))
+            for name, (host, port) in {**config["nodes"], **config.get("joining", {})}.items()}
+        self.joining: list[str] = sorted(config.get("joining", {}))
+        vnodes = config.get("vnodes", TP4_utils.CLUSTER_VNODES)
+        self.ring = HashRing(sorted(config["nodes"]), vnodes)
+        self.target_ring = HashRing(sorted(self.nodes), vnodes) if self.joining else self.ring
+
+    def owner(self, username: str) -> str:
+        """
+        Retourne le nom du nœud propriétaire de l’utilisateur, qui reçoit ses
+        sessions et ses courriels.
+        """
+        return self.ring.node_for(username)
+
+    def target_owner(self, username: str) -> str:
+        """
+        Retourne le nom du nœud propriétaire de l’utilisateur une fois les
+        nœuds en cours d’ajout intégrés à la grappe. C’est le nœud vers
+        lequel le rééquilibrage transfère sa boîte.
+        """
+        return self.target_ring.node_for(username)
+
+    def address(self, node: str) -> tuple[str, int]:
+        return self.nodes[node]
+
+    def reload(self) -> "ClusterConfig":
+        """
+        Retourne la configuration relue si le fichier a été modifié,
+        sinon la configuration actuelle.
+        """
+        if os.path.getmtime(self.path) != self.mtime:
+            return ClusterConfig(self.path)
+        return self
+
+    def promote(self) -> "ClusterConfig":
+        """
+        Ajoute les nœuds en cours d’ajout aux nœuds de la grappe dans le
+        fichier de configuration, puis retourne la configuration relue.
+        """
+        with open(self.path, "r") as f:
+            config = json.load(f)
+        config["nodes"].update(config.pop("joining", {}))
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(config, f, indent=4)
+        os.replace(tmp_path, self.path)
+        return ClusterConfig(self.path)
+
+
+def request(address: tuple[str, int], message: dict,
+            timeout: Optional[float] = None) -> Optional[TP4_utils.GLO_message]:
+    """
+    Ouvre une connexion vers un nœud, lui transmet un message et retourne
+    sa réponse, ou None si le nœud a fermé la connexion.
+
+    Lève OSError si le nœud est injoignable et ValueError si sa réponse
+    n’est pas un GLO_message valide.
+    """
+    with socket.create_connection(address, timeout=timeout) as soc:
+        glosocket.send_msg(soc, json.dumps(message))
+        response = glosocket.recv_msg(soc)
+    if response is None:
+        return None
+    try:
+        response = json.loads(response)
+        return TP4_utils.GLO_message(
+            header=TP4_utils.message_header(response["header"]),
+            data=response["data"]
+        )
+    except (KeyError, TypeError) as ex:
+        raise ValueError(f"Réponse invalide : {ex}")
+
+
+class Outbox:
+
+    def __init__(self, path: str = TP4_utils.SERVER_OUTBOX_DIR) -> None:
+        """
+        Prépare la file d’envoi sur disque des courriels destinés à un autre
+        nœud. Chaque courriel est écrit dans son propre fichier jusqu’à ce
+        que le nœud propriétaire en confirme la réception.
+        """
+        self.path = path
+        self._filename_pattern = re.compile(r"^([0-9]+)-(.+)$")
+        os.makedirs(path, exist_ok=True)
+        existing = [int(name.split("-")[0]) for name in os.listdir(path)
+                    if name.split("-")[0].isdigit()]
+        self._next_id = max(existing, default=0) + 1
+
+    def put(self, username: str, email_string: str) -> None:
+        """
+        Ajoute à la file un courriel destiné à l’utilisateur «username».
+        """
+        filename = f"{self._next_id}-{username}"
+        self._next_id += 1
+        tmp_path = os.path.join(self.path, f".{filename}.tmp")
+        with open(tmp_path, "w") as f:
+            f.write(email_string)
+        os.replace(tmp_path, os.path.join(self.path, filename))
+
+    def pending(self) -> Iterator[tuple[str, str, str]]:
+        """
+        Produit, dans l’ordre d’arrivée, le nom du fichier, l’utilisateur
+        destinataire et le contenu de chaque courriel en attente. Les fichiers
+        qui ne suivent pas le format de la file ou qui sont illisibles sont
+        ignorés.
+        """
+        entries = []
+        for filename in os.listdir(self.path):
+            match = self._filename_pattern.match(filename)
+            if match is not None:
+                entries.append((int(match.group(1)), filename, match.group(2)))
+        for _, filename, username in sorted(entries):
+            try:
+                with open(os.path.join(self.path, filename), "r") as f:
+                    content = f.read()
+            except (OSError, ValueError) as ex:
+                print(f"Fichier {filename} de la file d'envoi illisible : {ex}")
+                continue
+            yield filename, username, content
+
+    def remove(self, filename: str) -> None:
+        os.remove(os.path.join(self.path, filename))
+
+
+def rebalance(config: ClusterConfig,
+              timeout: float = TP4_utils.CLUSTER_REQUEST_TIMEOUT) -> None:
+    """
+    Demande à chaque nœud, un à la fois, de relire la configuration de la
+    grappe et de transférer les utilisateurs qui ne lui appartiennent plus,
+    puis consulte sa progression jusqu’à la fin des transferts. Un nœud qui
+    ne répond pas dans le délai «timeout» est signalé puis ignoré.
+
+    Si tous les transferts ont réussi, les nœuds en cours d’ajout sont
+    ajoutés aux nœuds de la grappe, qui leur dirige alors leurs utilisateurs.
+    """
+    complete = True
+    for node in sorted(config.nodes):
+        message = {"header": TP4_utils.message_header.CLUSTER_REBALANCE,
+                   "data": {"secret": config.secret, "start": True}}
+        try:
+            response = request(config.address(node), message, timeout)
+            while response is not None and response["header"] == TP4_utils.message_header.OK \
+                    and response["data"]["running"]:
+                time.sleep(TP4_utils.CLUSTER_REBALANCE_POLL_INTERVAL)
+                message["data"]["start"] = False
+                response = request(config.address(node), message, timeout)
+        except (OSError, ValueError, KeyError, TypeError) as ex:
+            print(f"{node} : injoignable ({ex!r})")
+            complete = False
+            continue
+
+        if response is None:
+            print(f"{node} : aucune réponse")
+            complete = False
+        elif response["header"] == TP4_utils.message_header.ERROR:
+            print(f"{node} : {response['data']}")
+            complete = False
+        else:
+            print(f"{node} : {response['data']['moved']} boîte(s) transférée(s), "
+                  f"{response['data']['failed']} échec(s)")
+            complete = complete and not response["data"]["failed"]
+
+    if config.joining:
+        if complete:
+            config.promote()
+            print(f"Nœuds ajoutés à la grappe : {', '.join(config.joining)}")
+        else:
+            print("Des transferts ont échoué : relancez le rééquilibrage avant "
+                  "d'ajouter les nouveaux nœuds à la grappe.")
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(
+        description="Rééquilibre les utilisateurs après l'ajout d'un nœud.")
+    parser.add_argument("config", type=str, action="store",
+                        help="fichier de configuration de la grappe")
+    parser.add_argument("--timeout", dest="timeout", type=float, action="store",
+                        default=TP4_utils.CLUSTER_REQUEST_TIMEOUT,
+                        help="secondes accordées à chaque nœud pour répondre")
+    args = parser.parse_args()
+    rebalance(ClusterConfig(args.config), args.timeout)
+    exit(0)
+
+
+if __name__ == "__main__":
+    main()
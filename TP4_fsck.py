@@ -0,0 +1,164 @@
+"""\
+Module fournissant la vérification d’intégrité («fsck») des boîtes de
+courriels.
+
+Chaque boîte est vérifiée dans un processus d’un bassin : les courriels
+illisibles ou mal formés, les fichiers d’état corrompus et les fichiers
+inconnus sont signalés, puis déplacés dans le dossier de quarantaine par
+le processus principal. La vérification précalcule aussi l’index des
+entêtes de chaque boîte.
+"""
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import re
+import shutil
+from typing import Callable, Iterator, Optional
+
+import TP4_mailbox
+import TP4_utils
+
+
+def check_mailbox(root: str, username: str) -> dict:
+    """
+    Vérifie la boîte de l’utilisateur sans la modifier.
+
+    Cette fonction est exécutée dans un processus du bassin, elle ne doit
+    donc retourner que des données sérialisables. Le dictionnaire retourné
+    contient les entrées:
+    - «root» et «username», qui identifient la boîte,
+    - «headers», la source et le sujet de chaque courriel valide,
+    - «corrupt», les noms des fichiers à mettre en quarantaine,
+    - «size», la taille totale des courriels valides en octets.
+    """
+    path = os.path.join(root, username)
+    pattern = re.compile(f"^([0-9]+)-{re.escape(username)}$")
+    headers: dict[int, tuple[str, str]] = {}
+    corrupt: list[str] = []
+    size = 0
+
+    for entry in os.scandir(path):
+        if entry.name == TP4_utils.PASSWORD_FILE and entry.is_file():
+            continue
+
+        if entry.name == TP4_utils.MAILBOX_STATE_FILE and entry.is_file():
+            try:
+                with open(entry.path, "r", encoding="utf-8") as f:
+                    if not isinstance(json.load(f), dict):
+                        raise ValueError()
+            except ValueError:
+                corrupt.append(entry.name)
+            continue
+
+        match = pattern.match(entry.name)
+        if match is None or not entry.is_file():
+            # Fichier inconnu, par exemple une écriture interrompue
+            corrupt.append(entry.name)
+            continue
+
+        try:
+            with open(entry.path, "r", encoding="utf-8") as f:
+                parsed = TP4_mailbox.parse_email(f.read())
+        except ValueError:
+            # Contenu mal formé ou qui n'est pas de l'UTF-8 valide
+            corrupt.append(entry.name)
+            continue
+        headers[int(match.group(1))] = (parsed["source"], parsed["subject"])
+        size += entry.stat().st_size
+
+    return {"root": root, "username": username, "headers": headers,
+            "corrupt": corrupt, "size": size}
+
+
+def quarantine(result: dict) -> list[str]:
+    """
+    Déplace les fichiers corrompus signalés par check_mailbox dans le
+    dossier de quarantaine et retourne leurs nouveaux chemins.
+    """
+    root_name = os.path.basename(os.path.normpath(result["root"]))
+    destination_dir = os.path.join(
+        TP4_utils.SERVER_QUARANTINE_DIR, root_name, result["username"])
+
+    moved = []
+    for filename in result["corrupt"]:
+        source = os.path.join(result["root"], result["username"], filename)
+        if not os.path.exists(source):
+            continue
+        os.makedirs(destination_dir, exist_ok=True)
+        destination = os.path.join(destination_dir, filename)
+        suffix = 1
+        while os.path.exists(destination):
+            destination = os.path.join(destination_dir, f"{filename}.{suffix}")
+            suffix += 1
+        shutil.move(source, destination)
+        moved.append(destination)
+    return moved
+
+
+def list_mailboxes(roots: list[str]) -> list[tuple[str, str]]:
+    """
+    Retourne la paire (dossier racine, nom d’utilisateur) de chaque boîte.
+    """
+    mailboxes = []
+    for root in roots:
+        if not os.path.isdir(root):
+            continue
+        for username in sorted(os.listdir(root)):
+            if os.path.isdir(os.path.join(root, username)):
+                mailboxes.append((root, username))
+    return mailboxes
+
+
+def scan(mailboxes: list[tuple[str, str]], workers: Optional[int] = None,
+         progress: Optional[Callable[[int, int], None]] = None) -> Iterator[dict]:
+    """
+    Vérifie les boîtes en parallèle et produit le résultat de chacune dès
+    qu’il est disponible. La fonction «progress» reçoit le nombre de boîtes
+    vérifiées et le nombre total.
+    """
+    total = len(mailboxes)
+    if not total:
+        return
+
+    # «spawn» évite de dupliquer les fils du serveur déjà démarrés
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = {pool.submit(check_mailbox, root, username): (root, username)
+                   for root, username in mailboxes}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+            try:
+                yield future.result()
+            except OSError as ex:
+                root, username = futures[future]
+                print(f"Impossible de vérifier {os.path.join(root, username)} : {ex}")
+            if progress is not None:
+                progress(done, total)
+
+
+def print_progress(done: int, total: int) -> None:
+    """
+    Affiche la progression de la vérification environ tous les dix pour cent.
+    """
+    if done == total or done % max(1, total // 10) == 0:
+        print(f"Vérification des boîtes : {done}/{total}")
+
+
+def fsck(roots: list[str], workers: Optional[int] = None) -> int:
+    """
+    Vérifie hors ligne toutes les boîtes des dossiers racines, met les
+    fichiers corrompus en quarantaine et retourne le nombre de fichiers
+    déplacés.
+    """
+    mailboxes = list_mailboxes(roots)
+    count, size, quarantined = 0, 0, 0
+    for result in scan(mailboxes, workers, print_progress):
+        count += len(result["headers"])
+        size += result["size"]
+        for path in quarantine(result):
+            print(f"Mis en quarantaine : {path}")
+            quarantined += 1
+
+    print(f"{len(mailboxes)} boîte(s), {count} courriel(s), {size} octets, "
+          f"{quarantined} fichier(s) en quarantaine")
+    return quarantined
@@ -0,0 +1,331 @@
+"""\
+Module fournissant la gestion des boîtes de courriels sur disque.
+
+Chaque boîte est un dossier contenant un fichier par courriel, nommé
+«<numéro>-<utilisateur>», ainsi qu’un fichier d’état qui conserve les
+pierres tombales (courriels supprimés), les drapeaux de lecture et le
+dossier de chaque courriel. Une suppression ne fait qu’ajouter une pierre
+tombale; l’espace est récupéré plus tard par le compactage.
+
+Chaque modification incrémente la séquence de modification («modseq») de
+la boîte et est inscrite dans un journal borné, ce qui permet à un client
+de ne récupérer que les changements depuis sa dernière synchronisation.
+"""
+import json
+import os
+import re
+import threading
+import time
+from typing import Optional
+
+import TP4_utils
+
+
+def parse_email(content: str) -> dict[str, str]:
+    """
+    Extrait la source, la destination, le sujet et le contenu d’un courriel
+    tel qu’il est écrit sur le disque.
+
+    Lève ValueError si le courriel n’a pas le format attendu.
+    """
+    lines = content.split('\n')
+    try:
+        return {
+            "source": lines[0].split(' ')[1],
+            "destination": lines[1].split(' ')[1],
+            "subject": lines[2].split(' ')[1],
+            "content": '\n'.join(lines[6:])
+        }
+    except IndexError:
+        raise ValueError("Le courriel n'a pas le format attendu.")
+
+
+def _new_epoch() -> str:
+    return os.urandom(8).hex()
+
+
+class Mailbox:
+
+    def __init__(self, path: str, username: str) -> None:
+        """
+        Prépare la boîte de courriels située dans le dossier «path».
+
+        Le verrou «lock» doit être détenu pour toute opération qui lit ou
+        modifie la boîte, puisque le compactage s’exécute dans un autre fil.
+        """
+        self.path = path
+        self.username = username
+        self.lock = threading.RLock()
+        self._filename_pattern = re.compile(
+            f"^([0-9]+)-{re.escape(username)}$")
+
+        self._deleted: set[int] = set()
+        self._read: set[int] = set()
+        self._folders: dict[int, str] = {}
+        # Index des entêtes (source, sujet) déjà lus, par numéro de courriel
+        self._headers: dict[int, tuple[str, str]] = {}
+
+        # L'époque change quand les numéros ne sont plus comparables (boîte
+        # recréée ou compactée) : un client doit alors tout resynchroniser.
+        self.epoch = _new_epoch()
+        self.modseq = 0
+        # Le journal contient tous les changements dont la séquence est
+        # supérieure à «_log_start»
+        self._log_start = 0
+        self._changes: list[tuple[int, int]] = []
+        self._load_state()
+
+    def _state_path(self) -> str:
+        return os.path.join(self.path, TP4_utils.MAILBOX_STATE_FILE)
+
+    def _load_state(self) -> None:
+        """
+        Charge le fichier d’état s’il existe. Un fichier absent ou illisible
+        équivaut à une boîte sans pierre tombale ni drapeau.
+        """
+        try:
+            with open(self._state_path(), "r") as f:
+                state = json.load(f)
+            self._deleted = set(state.get("deleted", []))
+            self._read = set(state.get("read", []))
+            self._folders = {int(number): folder
+                             for number, folder in state.get("folders", {}).items()}
+            self.epoch = state.get("epoch", self.epoch)
+            self.modseq = state.get("modseq", 0)
+            self._log_start = state.get("log_start", 0)
+            self._changes = [(seq, number) for seq, number in state.get("changes", [])]
+        except (OSError, ValueError, AttributeError, TypeError):
+            pass
+
+    def _save_state(self) -> None:
+        """
+        Écrit le fichier d’état dans un fichier temporaire puis le remplace
+        pour éviter de laisser un état à moitié écrit.
+        """
+        tmp_path = self._state_path() + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "deleted": sorted(self._deleted),
+                "read": sorted(self._read),
+                "folders": {str(number): folder
+                            for number, folder in self._folders.items()},
+                "epoch": self.epoch,
+                "modseq": self.modseq,
+                "log_start": self._log_start,
+                "changes": self._changes
+            }, f)
+        os.replace(tmp_path, self._state_path())
+
+    def _record_change(self, number: int) -> None:
+        """
+        Incrémente la séquence de modification et inscrit le courriel modifié
+        au journal. Le fichier d’état doit ensuite être sauvegardé.
+        """
+        self.modseq += 1
+        self._changes.append((self.modseq, number))
+        if len(self._changes) > TP4_utils.MAILBOX_CHANGELOG_SIZE:
+            dropped = self._changes[:-TP4_utils.MAILBOX_CHANGELOG_SIZE]
+            self._changes = self._changes[-TP4_utils.MAILBOX_CHANGELOG_SIZE:]
+            self._log_start = dropped[-1][0]
+
+    def changes_since(self, modseq: int) -> Optional[set[int]]:
+        """
+        Retourne les numéros des courriels modifiés après la séquence
+        «modseq», ou None si le journal ne remonte pas aussi loin.
+        """
+        with self.lock:
+            if modseq < self._log_start or modseq > self.modseq:
+                return None
+            return {number for seq, number in self._changes if seq > modseq}
+
+    def filename(self, number: int) -> str:
+        return f"{number}-{self.username}"
+
+    def _file_numbers(self) -> list[int]:
+        """
+        Retourne les numéros de tous les fichiers de courriel présents dans
+        le dossier, pierres tombales comprises.
+        """
+        if not os.path.isdir(self.path):
+            return []
+        numbers = []
+        for file in os.listdir(self.path):
+            match = self._filename_pattern.match(file)
+            if match is not None:
+                numbers.append(int(match.group(1)))
+        return sorted(numbers)
+
+    def numbers(self, folder: Optional[str] = TP4_utils.DEFAULT_FOLDER) -> list[int]:
+        """
+        Retourne les numéros des courriels non supprimés du dossier demandé,
+        ou de tous les dossiers si «folder» est None.
+        """
+        with self.lock:
+            return [number for number in self._file_numbers()
+                    if number not in self._deleted
+                    and (folder is None or self.folder(number) == folder)]
+
+    def exists(self, number: int) -> bool:
+        with self.lock:
+            return number not in self._deleted and \
+                os.path.isfile(os.path.join(self.path, self.filename(number)))
+
+    def size(self, number: int) -> int:
+        """
+        Retourne la taille du fichier du courriel en octets.
+        """
+        return os.path.getsize(os.path.join(self.path, self.filename(number)))
+
+    def read_email(self, number: int) -> str:
+        with self.lock:
+            with open(os.path.join(self.path, self.filename(number)), "r") as f:
+                return f.read()
+
+    def header(self, number: int) -> tuple[str, str]:
+        """
+        Retourne la source et le sujet du courriel. Le fichier n’est lu que
+        si l’entête n’est pas déjà dans l’index.
+        """
+        with self.lock:
+            if number not in self._headers:
+                parsed = parse_email(self.read_email(number))
+                self._headers[number] = (parsed["source"], parsed["subject"])
+            return self._headers[number]
+
+    def seed_headers(self, headers: dict[int, tuple[str, str]]) -> None:
+        """
+        Ajoute à l’index des entêtes précalculés, par exemple par la
+        vérification au démarrage.
+        """
+        with self.lock:
+            self._headers.update(headers)
+
+    def deliver(self, email_string: str) -> int:
+        """
+        Écrit un nouveau courriel dans la boîte et retourne son numéro.
+
+        Le numéro suit le plus grand numéro présent sur le disque, pierres
+        tombales comprises, pour ne jamais réutiliser un fichier à supprimer.
+        """
+        with self.lock:
+            if not os.path.isdir(self.path):
+                os.mkdir(self.path)
+            numbers = self._file_numbers()
+            number = (numbers[-1] if numbers else 0) + 1
+            # Écriture dans un fichier temporaire puis renommage : un arrêt
+            # brutal ne laisse jamais de courriel à moitié écrit.
+            path = os.path.join(self.path, self.filename(number))
+            tmp_path = os.path.join(self.path, f".{self.filename(number)}.tmp")
+            with open(tmp_path, "w") as f:
+                f.write(email_string)
+            os.replace(tmp_path, path)
+            self._headers.pop(number, None)
+            self._record_change(number)
+            self._save_state()
+            return number
+
+    def is_read(self, number: int) -> bool:
+        return number in self._read
+
+    def folder(self, number: int) -> str:
+        return self._folders.get(number, TP4_utils.DEFAULT_FOLDER)
+
+    def delete(self, number: int) -> bool:
+        """
+        Ajoute une pierre tombale au courriel. Le fichier reste sur le disque
+        jusqu’au prochain compactage.
+        """
+        with self.lock:
+            if not self.exists(number):
+                return False
+            self._deleted.add(number)
+            self._record_change(number)
+            self._save_state()
+            return True
+
+    def set_read(self, number: int, read: bool) -> bool:
+        with self.lock:
+            if not self.exists(number):
+                return False
+            if read == self.is_read(number):
+                return True
+            if read:
+                self._read.add(number)
+            else:
+                self._read.discard(number)
+            self._record_change(number)
+            self._save_state()
+            return True
+
+    def move(self, number: int, folder: str) -> bool:
+        with self.lock:
+            if not self.exists(number):
+                return False
+            if folder == self.folder(number):
+                return True
+            if folder == TP4_utils.DEFAULT_FOLDER:
+                self._folders.pop(number, None)
+            else:
+                self._folders[number] = folder
+            self._record_change(number)
+            self._save_state()
+            return True
+
+    def expire(self, max_age_days: int) -> int:
+        """
+        Ajoute une pierre tombale aux courriels plus vieux que «max_age_days»
+        jours et retourne le nombre de courriels expirés.
+        """
+        limit = time.time() - max_age_days * 24 * 60 * 60
+        expired = 0
+        with self.lock:
+            for number in self.numbers(None):
+                path = os.path.join(self.path, self.filename(number))
+                if os.path.getmtime(path) < limit:
+                    self._deleted.add(number)
+                    self._record_change(number)
+                    expired += 1
+            if expired:
+                self._save_state()
+        return expired
+
+    def compact(self) -> int:
+        """
+        Supprime les fichiers marqués d’une pierre tombale puis renumérote
+        les courriels restants à partir de 1. Retourne le nombre de fichiers
+        supprimés.
+        """
+        with self.lock:
+            numbers = self._file_numbers()
+            live = [number for number in numbers if number not in self._deleted]
+            if len(live) == len(numbers) and live == list(range(1, len(live) + 1)):
+                return 0
+
+            for number in numbers:
+                if number in self._deleted:
+                    os.remove(os.path.join(self.path, self.filename(number)))
+
+            # Les nouveaux numéros sont toujours inférieurs ou égaux aux
+            # anciens : renommer en ordre croissant n’écrase aucun fichier.
+            read, folders, headers = set(), {}, {}
+            for new_number, old_number in enumerate(live, start=1):
+                if new_number != old_number:
+                    os.replace(os.path.join(self.path, self.filename(old_number)),
+                               os.path.join(self.path, self.filename(new_number)))
+                if old_number in self._read:
+                    read.add(new_number)
+                if old_number in self._folders:
+                    folders[new_number] = self._folders[old_number]
+                if old_number in self._headers:
+                    headers[new_number] = self._headers[old_number]
+
+            self._deleted, self._read, self._folders = set(), read, folders
+            self._headers = headers
+
+            # La renumérotation invalide les numéros connus des clients
+            self.epoch = _new_epoch()
+            self.modseq += 1
+            self._log_start = self.modseq
+            self._changes = []
+            self._save_state()
+            return len(numbers) - len(live)
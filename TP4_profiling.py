@@ -0,0 +1,116 @@
+"""\
+Module fournissant le journal des requêtes lentes et le profilage à la
+demande des requêtes du serveur.
+
+Le chronométrage d’une requête se limite à quelques appels à
+time.perf_counter, et le profilage ne coûte qu’une vérification de
+dictionnaire tant qu’il n’a pas été activé.
+"""
+import cProfile
+import os
+import time
+from typing import Optional, TextIO
+
+import TP4_utils
+
+
+class RequestTiming:
+    """
+    Chronométrage d’une requête, découpé en phases (recv, decode, handler,
+    encode, send). Chaque appel à mark termine la phase en cours.
+    """
+    __slots__ = ("_start", "_last", "phases")
+
+    def __init__(self) -> None:
+        self._start = self._last = time.perf_counter()
+        self.phases: dict[str, float] = {}
+
+    def mark(self, phase: str) -> None:
+        now = time.perf_counter()
+        self.phases[phase] = now - self._last
+        self._last = now
+
+    def total(self) -> float:
+        return self._last - self._start
+
+
+class SlowRequestLog:
+
+    def __init__(self, threshold: float = TP4_utils.SLOW_REQUEST_THRESHOLD,
+                 path: Optional[str] = None) -> None:
+        """
+        Prépare le journal des requêtes dont la durée dépasse «threshold»
+        secondes. Les entrées sont ajoutées au fichier «path», ou affichées
+        dans le terminal si aucun fichier n’est donné. Un seuil négatif
+        désactive le journal.
+        """
+        self.threshold = threshold
+        self._file: Optional[TextIO] = open(path, "a") if path is not None else None
+
+    def record(self, header: TP4_utils.message_header, username: Optional[str],
+               timing: RequestTiming) -> None:
+        total = timing.total()
+        if self.threshold < 0 or total < self.threshold:
+            return
+
+        phases = " ".join(f"{phase}={duration * 1000:.1f}"
+                          for phase, duration in timing.phases.items())
+        line = TP4_utils.SLOW_REQUEST_DISPLAY.format(
+            header=header.name, username=username, duration=total * 1000, phases=phases)
+        if self._file is None:
+            print(line)
+        else:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+
+class Profiler:
+
+    def __init__(self, output_dir: str = TP4_utils.PROFILE_DIR) -> None:
+        """
+        Prépare le profilage à la demande. Les statistiques de chaque requête
+        profilée sont écrites au format pstats dans «output_dir».
+        """
+        self.output_dir = output_dir
+        self._remaining: dict[TP4_utils.message_header, int] = {}
+        self._count = 0
+
+    def enable(self, header: TP4_utils.message_header, count: int) -> None:
+        """
+        Active le profilage des «count» prochaines requêtes portant l’entête
+        «header». Un compte nul le désactive.
+        """
+        if count > 0:
+            self._remaining[header] = count
+        else:
+            self._remaining.pop(header, None)
+
+    def start(self, header: TP4_utils.message_header) -> Optional[cProfile.Profile]:
+        """
+        Démarre le profilage de la requête si elle doit être profilée.
+        Retourne None dans le cas contraire.
+        """
+        if header not in self._remaining:
+            return None
+
+        self._remaining[header] -= 1
+        if not self._remaining[header]:
+            del self._remaining[header]
+
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, profile: cProfile.Profile, header: TP4_utils.message_header) -> str:
+        """
+        Arrête le profilage et écrit les statistiques. Retourne le chemin
+        du fichier pstats.
+        """
+        profile.disable()
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._count += 1
+        path = os.path.join(
+            self.output_dir,
+            f"{header.name}-{time.strftime('%Y%m%d-%H%M%S')}-{self._count}.pstats")
+        profile.dump_stats(path)
+        return path
@@ -0,0 +1,318 @@
+"""\
+Module fournissant le mandataire frontal du mode grappe.
+
+Le mandataire accepte les clients sur le port habituel du serveur et
+relaie chaque session vers le nœud propriétaire de l’utilisateur, choisi
+par hachage cohérent sur le nom d’utilisateur de la demande de connexion
+ou de création de compte. Une fois la session authentifiée, les messages
+sont relayés tels quels dans les deux sens, notifications comprises.
+"""
+import argparse
+import errno
+import json
+import select
+import socket
+from typing import NoReturn, Optional
+
+import glosocket
+import TP4_cluster
+import TP4_utils
+
+
+class Proxy:
+
+    def __init__(self, cluster_config: str, host: str = "127.0.0.1",
+                 port: int = TP4_utils.SOCKET_PORT) -> None:
+        """
+        Cette méthode charge la configuration de la grappe, initialise le
+        socket du mandataire et prépare le suivi des sessions:
+        - «_backends» associe chaque socket client au socket du nœud,
+        - «_clients» associe chaque socket de nœud au socket client,
+        - «_session_nodes» garde le nom du nœud de chaque session,
+        - «_authenticated» contient les clients authentifiés,
+        - «_pending_auth» contient les clients qui attendent la réponse à
+            une demande d’authentification,
+        - «_connecting» contient les sockets de nœud en cours de connexion,
+        - «_inbound» et «_outbound» contiennent les octets reçus d’un socket
+            et pas encore découpés en messages, et ceux en attente d’envoi.
+
+        Tous les sockets sont non bloquants : un nœud lent ou un client qui
+        ne lit pas ses réponses ne retarde jamais les autres sessions.
+        """
+        self._cluster = TP4_cluster.ClusterConfig(cluster_config)
+
+        socket_proxy = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        socket_proxy.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        socket_proxy.bind((host, port))
+        socket_proxy.listen(5)
+        self._proxy_socket = socket_proxy
+
+        self._client_socket_list: list[socket.socket] = []
+        self._backends: dict[socket.socket, socket.socket] = {}
+        self._clients: dict[socket.socket, socket.socket] = {}
+        self._session_nodes: dict[socket.socket, str] = {}
+        self._authenticated: set[socket.socket] = set()
+        self._pending_auth: set[socket.socket] = set()
+        self._connecting: set[socket.socket] = set()
+        self._inbound: dict[socket.socket, bytearray] = {}
+        self._outbound: dict[socket.socket, bytearray] = {}
+
+    def _main_loop(self) -> None:
+        """
+        Boucle principale du mandataire.
+
+        Le mandataire utilise le module select pour récupérer les sockets en
+        attente puis appelle l’une des méthodes _accept_client,
+        _relay_from_client ou _relay_from_backend pour chacun d’entre eux.
+        Les sockets prêts en écriture terminent leur connexion ou reçoivent
+        les messages qui leur sont en attente. Un socket n’est pas lu tant
+        que l’autre extrémité de sa session a trop de messages en attente.
+        """
+        while True:
+            readers = [waiting for waiting in self._client_socket_list + list(self._clients)
+                       if waiting not in self._connecting and not self._is_full(self._peer(waiting))]
+            writers = list(self._connecting) + [waiting for waiting in self._outbound
+                                                if waiting not in self._connecting]
+            waiting_list, writable_list, _ = select.select(
+                [self._proxy_socket] + readers, writers, []
+            )
+
+            for writable in writable_list:
+                if writable in self._connecting:
+                    self._finish_connect(writable)
+                elif writable in self._outbound:
+                    self._flush(writable)
+
+            for waiting in waiting_list:
+                if waiting == self._proxy_socket:
+                    self._accept_client()
+                elif waiting in self._clients:
+                    self._relay_from_backend(waiting)
+                elif waiting in self._client_socket_list:
+                    self._relay_from_client(waiting)
+
+    def _accept_client(self) -> None:
+        client, _ = self._proxy_socket.accept()
+        client.setblocking(False)
+        self._client_socket_list.append(client)
+
+    def _peer(self, source: socket.socket) -> Optional[socket.socket]:
+        """
+        Retourne l’autre extrémité de la session du socket, s’il y en a une.
+        """
+        return self._clients.get(source) or self._backends.get(source)
+
+    def _is_full(self, destination: Optional[socket.socket]) -> bool:
+        return destination is not None and \
+            len(self._outbound.get(destination, b"")) > TP4_utils.OUTGOING_BUFFER_LIMIT
+
+    def _recv(self, source: socket.socket) -> Optional[list[str]]:
+        """
+        Lit les octets disponibles sur le socket et retourne les messages
+        complets reçus, ou None si la connexion est fermée ou invalide.
+        """
+        try:
+            data = source.recv(65536)
+        except BlockingIOError:
+            return []
+        except OSError:
+            return None
+        if not data:
+            return None
+
+        buffer = self._inbound.setdefault(source, bytearray())
+        buffer += data
+        try:
+            return glosocket.decode_msgs(buffer)
+        except UnicodeDecodeError:
+            return None
+
+    def _send(self, destination: socket.socket, message: str) -> None:
+        """
+        Ajoute un message à ceux en attente d’envoi vers le socket, puis en
+        envoie ce qui peut l’être sans bloquer.
+        """
+        self._outbound.setdefault(destination, bytearray()).extend(
+            glosocket.encode_msg(message))
+        if destination not in self._connecting:
+            self._flush(destination)
+
+    def _flush(self, destination: socket.socket) -> None:
+        """
+        Envoie sans bloquer les messages en attente vers le socket. La
+        session est fermée si l’envoi échoue.
+        """
+        buffer = self._outbound[destination]
+        try:
+            while buffer:
+                del buffer[:destination.send(buffer)]
+        except BlockingIOError:
+            return
+        except OSError:
+            self._close_session(self._clients.get(destination, destination))
+            return
+        del self._outbound[destination]
+
+    def _forget(self, source: socket.socket) -> None:
+        source.close()
+        self._inbound.pop(source, None)
+        self._outbound.pop(source, None)
+
+    def _close_session(self, client: socket.socket) -> None:
+        """
+        Ferme le socket client, le socket du nœud associé s’il existe, et
+        retire la session des structures de suivi.
+        """
+        if client not in self._client_socket_list:
+            return
+        self._close_backend(client)
+        self._forget(client)
+        self._client_socket_list.remove(client)
+        self._authenticated.discard(client)
+        self._pending_auth.discard(client)
+
+    def _close_backend(self, client: socket.socket) -> None:
+        backend = self._backends.pop(client, None)
+        if backend is not None:
+            self._forget(backend)
+            self._connecting.discard(backend)
+            del self._clients[backend]
+        self._session_nodes.pop(client, None)
+
+    def _unavailable(self, client: socket.socket) -> None:
+        self._pending_auth.discard(client)
+        self._send(client, json.dumps({
+            "header": TP4_utils.message_header.ERROR,
+            "data": "Le serveur de ce compte est indisponible."
+        }))
+
+    def _route(self, client: socket.socket, raw_message: str) -> Optional[socket.socket]:
+        """
+        Retourne le socket du nœud propriétaire de l’utilisateur nommé dans
+        une demande d’authentification, en ouvrant la connexion au besoin.
+        La connexion est non bloquante : les messages sont mis en attente
+        jusqu’à ce qu’elle soit établie.
+
+        Retourne None si le message n’est pas une demande d’authentification
+        valide ou si le nœud est injoignable; le client en est alors informé
+        ou déconnecté.
+        """
+        try:
+            message = json.loads(raw_message)
+            header = TP4_utils.message_header(message["header"])
+            username = message["data"]["username"]
+        except (ValueError, TypeError, KeyError):
+            header, username = None, None
+
+        if header not in (TP4_utils.message_header.AUTH_LOGIN,
+                          TP4_utils.message_header.AUTH_REGISTER) or not isinstance(username, str):
+            self._close_session(client)
+            return None
+
+        # Relire la configuration permet d'ajouter un nœud sans redémarrer
+        self._cluster = self._cluster.reload()
+        node = self._cluster.owner(username)
+        if self._session_nodes.get(client) == node:
+            return self._backends[client]
+
+        self._close_backend(client)
+        backend = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        backend.setblocking(False)
+        try:
+            error = backend.connect_ex(self._cluster.address(node))
+        except OSError as ex:
+            error = ex.errno
+        if error not in (0, errno.EINPROGRESS):
+            backend.close()
+            self._unavailable(client)
+            return None
+
+        self._connecting.add(backend)
+        self._backends[client] = backend
+        self._clients[backend] = client
+        self._session_nodes[client] = node
+        return backend
+
+    def _finish_connect(self, backend: socket.socket) -> None:
+        """
+        Termine la connexion à un nœud et lui envoie les messages en attente,
+        ou informe le client que le nœud est injoignable.
+        """
+        self._connecting.discard(backend)
+        client = self._clients[backend]
+        if backend.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+            self._close_backend(client)
+            self._unavailable(client)
+        elif backend in self._outbound:
+            self._flush(backend)
+
+    def _relay_from_client(self, client: socket.socket) -> None:
+        """
+        Relaie les messages du client vers son nœud. Tant que la session
+        n’est pas authentifiée, chaque message doit être une demande
+        d’authentification, qui détermine le nœud de la session.
+        """
+        messages = self._recv(client)
+        if messages is None:
+            self._close_session(client)
+            return
+
+        for raw_message in messages:
+            if client in self._authenticated:
+                backend = self._backends[client]
+            else:
+                backend = self._route(client, raw_message)
+                if backend is None:
+                    if client not in self._client_socket_list:
+                        return
+                    continue
+                self._pending_auth.add(client)
+            self._send(backend, raw_message)
+            if client not in self._client_socket_list:
+                return
+
+    def _relay_from_backend(self, backend: socket.socket) -> None:
+        """
+        Relaie les messages d’un nœud vers son client. La réponse OK à une
+        demande d’authentification attache définitivement la session au nœud.
+        """
+        client = self._clients[backend]
+        messages = self._recv(backend)
+        if messages is None:
+            self._close_session(client)
+            return
+
+        for raw_message in messages:
+            if client in self._pending_auth:
+                self._pending_auth.discard(client)
+                try:
+                    if json.loads(raw_message)["header"] == TP4_utils.message_header.OK:
+                        self._authenticated.add(client)
+                except (ValueError, TypeError, KeyError):
+                    pass
+            self._send(client, raw_message)
+            if client not in self._client_socket_list:
+                return
+
+    def run(self) -> NoReturn:
+        """
+        Appelle la méthode _main_loop en boucle jusqu’à la fin du programme.
+        """
+        while True:
+            self._main_loop()
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config", type=str, action="store",
+                        help="fichier de configuration de la grappe")
+    parser.add_argument("--host", dest="host", type=str, action="store",
+                        default="127.0.0.1", help="adresse d'écoute")
+    parser.add_argument("--port", dest="port", type=int, action="store",
+                        default=TP4_utils.SOCKET_PORT, help="port d'écoute")
+    args = parser.parse_args()
+    Proxy(args.config, args.host, args.port).run()
+
+
+if __name__ == "__main__":
+    main()
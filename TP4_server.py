@@ -1,27 +1,57 @@
+import argparse
 import email
 import email.message
 import hashlib
+import hmac
 import json
 import os
 import re
 import select
+import shutil
+import signal
 import smtplib
 import socket
-from typing import NoReturn, Optional
+import threading
+import time
+from typing import Callable, NoReturn, Optional
 
 import glosocket
+import TP4_cluster
+import TP4_fsck
+import TP4_mailbox
+import TP4_profiling
 import TP4_utils
 
 
 class Server:
 
-    def __init__(self) -> None:
+    def __init__(self,
+                 compaction_interval: float = TP4_utils.COMPACTION_INTERVAL,
+                 retention_days: Optional[dict[str, Optional[int]]] = None,
+                 startup_scan: bool = True,
+                 scan_workers: Optional[int] = None,
+                 slow_request_threshold: float = TP4_utils.SLOW_REQUEST_THRESHOLD,
+                 slow_request_log: Optional[str] = None,
+                 profile_dir: str = TP4_utils.PROFILE_DIR,
+                 admin_users: Optional[list[str]] = None,
+                 signal_profile_header: TP4_utils.message_header =
+                 TP4_utils.message_header.INBOX_READING_REQUEST,
+                 signal_profile_count: int = 10,
+                 host: str = "127.0.0.1",
+                 port: int = TP4_utils.SOCKET_PORT,
+                 cluster_config: Optional[str] = None,
+                 node_name: Optional[str] = None) -> None:
         """
         Cette méthode est automatiquement appelée à l’instanciation du serveur, elle doit :
         - Initialiser le socket du serveur et le mettre en écoute.
         - Créer le dossier des données pour le serveur dans le dossier courant s’il n’existe pas.
         - Préparer deux listes vides pour les sockets clients.
         - Compiler un pattern Regex qui sera utilisé pour vérifier les adresses courriel.
+        - Préparer le registre des boîtes de courriels et la configuration du
+            compactage et de la vérification en arrière-plan.
+        - Préparer le journal des requêtes lentes et le profilage à la demande.
+        - En mode grappe, charger la configuration de la grappe et préparer
+            la file d’envoi vers les autres nœuds.
 
         Attention: ne changez pas le nom des attributs fournis, ils sont utilisés dans les tests.
         Vous pouvez cependant ajouter des attributs supplémentaires.
@@ -29,10 +59,15 @@ class Server:
         self._client_socket_list: list[socket.socket] = []
         self._connected_client_list: list[socket.socket] = []
         self._client_count = 0
+        self._client_usernames: dict[socket.socket, str] = {}
+        # Sockets abonnés aux notifications de nouveaux courriels, par utilisateur
+        self._subscribers: dict[str, set[socket.socket]] = {}
+        # Messages encodés en attente d'envoi aux clients connectés
+        self._outgoing: dict[socket.socket, bytearray] = {}
 
         socket_serveur = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         socket_serveur.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        socket_serveur.bind(("127.0.0.1", TP4_utils.SOCKET_PORT))
+        socket_serveur.bind((host, port))
         socket_serveur.listen(5)
         self._server_socket = socket_serveur
 
@@ -45,8 +80,84 @@ class Server:
 
         self._email_verificator = re.compile(
             r"\b[A-Za-z0-9._%+-]+@ulaval\.ca")
-
-    def _recv_data(self, source: socket.socket) -> Optional[TP4_utils.GLO_message]:
+        # Un nom d'utilisateur sert de nom de dossier : il ne peut commencer
+        # par un point, ce qui exclut aussi «.» et «..».
+        self._username_verificator = re.compile(r"^[A-Za-z0-9_+-][A-Za-z0-9._+-]*$")
+
+        self._mailboxes: dict[str, TP4_mailbox.Mailbox] = {}
+        self._mailboxes_lock = threading.Lock()
+        self._compaction_interval = compaction_interval
+        retention = dict(TP4_utils.RETENTION_DAYS)
+        if retention_days is not None:
+            retention.update(retention_days)
+        self._retention_days = {
+            self._server_data_path: retention.get(TP4_utils.SERVER_DATA_DIR),
+            self._server_lost_dir: retention.get(TP4_utils.SERVER_LOST_DIR),
+        }
+        self._compaction_thread: Optional[threading.Thread] = None
+
+        self._startup_scan = startup_scan
+        self._scan_workers = scan_workers
+        # Chemins des boîtes pas encore vérifiées pendant la vérification au démarrage
+        self._unchecked_mailboxes: set[str] = set()
+
+        self._slow_request_log = TP4_profiling.SlowRequestLog(
+            slow_request_threshold, slow_request_log)
+        self._profiler = TP4_profiling.Profiler(profile_dir)
+        self._admin_users = set(admin_users or [])
+        # Profilage activé par le signal SIGUSR1 : entête et nombre de requêtes
+        self._signal_profile = (signal_profile_header, signal_profile_count)
+
+        self._cluster: Optional[TP4_cluster.ClusterConfig] = None
+        self._node_name = node_name
+        self._outbox: Optional[TP4_cluster.Outbox] = None
+        self._outbox_event = threading.Event()
+        # Le rééquilibrage s'exécute dans un fil : chemins des boîtes en cours
+        # de transfert et progression rapportée à l'outil de rééquilibrage
+        self._rebalance_thread: Optional[threading.Thread] = None
+        self._rebalance_progress = {"running": False, "moved": 0, "failed": 0}
+        self._migrating: set[str] = set()
+        if cluster_config is not None:
+            self._cluster = TP4_cluster.ClusterConfig(cluster_config)
+            if node_name not in self._cluster.nodes:
+                raise ValueError(f"Le nœud {node_name} n'est pas dans la configuration de la grappe.")
+            self._outbox = TP4_cluster.Outbox()
+
+    def _get_mailbox(self, username: str, lost: bool = False) -> TP4_mailbox.Mailbox:
+        """
+        Retourne la boîte de courriels de l’utilisateur, dans le dossier des
+        données ou dans le dossier LOST. Une même instance est partagée entre
+        la boucle principale et le fil de compactage pour partager son verrou.
+        """
+        root = self._server_lost_dir if lost else self._server_data_path
+        path = os.path.join(root, username)
+        with self._mailboxes_lock:
+            if path not in self._mailboxes:
+                # Si la vérification au démarrage n'a pas encore atteint cette
+                # boîte, elle est vérifiée immédiatement avant son chargement.
+                result = None
+                if path in self._unchecked_mailboxes:
+                    result = TP4_fsck.check_mailbox(root, username)
+                self._load_mailbox(path, username, result)
+            return self._mailboxes[path]
+
+    def _load_mailbox(self, path: str, username: str, result: Optional[dict]) -> None:
+        """
+        Charge une boîte dans le registre. Si un résultat de vérification est
+        fourni, les fichiers corrompus sont mis en quarantaine et l’index des
+        entêtes est précalculé. Le verrou du registre doit être détenu.
+        """
+        self._unchecked_mailboxes.discard(path)
+        if result is not None:
+            for quarantined_path in TP4_fsck.quarantine(result):
+                print(f"Mis en quarantaine : {quarantined_path}")
+        mailbox = TP4_mailbox.Mailbox(path, username)
+        if result is not None:
+            mailbox.seed_headers(result["headers"])
+        self._mailboxes[path] = mailbox
+
+    def _recv_data(self, source: socket.socket,
+                   timing: Optional[TP4_profiling.RequestTiming] = None) -> Optional[TP4_utils.GLO_message]:
         """
         Cette méthode utilise le module glosocket pour récupérer un message.
         Elle doit être appelée systématiquement pour recevoir des données d’un client.
@@ -55,47 +166,115 @@ class Server:
         valide, qui est décodé avec le module json. Si le JSON est invalide,
         s’il ne représente pas un dictionnaire du format GLO_message, ou si
         le résultat est None, le socket client est fermé et retiré des listes.
+        Si un chronométrage est fourni, les phases «recv» et «decode» y sont
+        enregistrées.
         """
-        message = glosocket.recv_msg(source)
+        try:
+            message = glosocket.recv_msg(source)
+        except OSError:
+            # Connexion réinitialisée, par exemple si le client quitte sans
+            # avoir lu toutes les notifications qui lui ont été poussées
+            message = None
+        if timing is not None:
+            timing.mark("recv")
         try:
             message = json.loads(message)
             if "header" not in message or "data" not in message:
                 raise Exception()
         except Exception as ex:
             # Le json est invalide ou est none
-            source.close()
-            self._connected_client_list.remove(source)
-            self._client_socket_list.remove(source)
-            self._client_count -= 1
+            self._close_client(source)
             return
 
         # Si on arrive ici, c'est que le json est valide et représente un GLO_message
+        if timing is not None:
+            timing.mark("decode")
         return TP4_utils.GLO_message(
             header=TP4_utils.message_header(message["header"]),
             data=message["data"]
         )
 
+    def _close_client(self, source: socket.socket) -> None:
+        """
+        Ferme le socket client et le retire des listes.
+        """
+        source.close()
+        self._unsubscribe(source)
+        self._outgoing.pop(source, None)
+        self._client_usernames.pop(source, None)
+        if source in self._connected_client_list:
+            self._connected_client_list.remove(source)
+        self._client_socket_list.remove(source)
+        self._client_count -= 1
+
     def _main_loop(self) -> None:
         """
         Boucle principale du serveur.
 
         Le serveur utilise le module select pour récupérer les sockets en
         attente puis appelle l’une des méthodes _accept_client, _process_client
-        ou _authenticate_client pour chacun d’entre eux.
+        ou _authenticate_client pour chacun d’entre eux. Les sockets prêts en
+        écriture reçoivent les messages qui leur sont en attente.
         """
         while True:
-            waiting_list, _, _ = select.select(
-                [self._server_socket] + self._client_socket_list, [], []
+            waiting_list, writable_list, _ = select.select(
+                [self._server_socket] + self._client_socket_list, list(self._outgoing), []
             )
 
+            for client in writable_list:
+                if client in self._outgoing:
+                    self._flush(client)
+
             for client in waiting_list:
                 if client == self._server_socket:
                     self._accept_client()
+                elif client not in self._client_socket_list:
+                    # Client fermé plus tôt dans cette itération
+                    continue
                 elif client in self._connected_client_list:
                     self._process_client(client)
                 else:
                     self._authenticate_client(client)
 
+    def _queue_msg(self, client_socket: socket.socket, message: str,
+                   limit: Optional[int] = None) -> None:
+        """
+        Ajoute un message aux messages en attente du client puis en envoie
+        ce qui peut l’être sans bloquer; le reste est envoyé lorsque select
+        indique que le socket est prêt en écriture. Si «limit» est donné et
+        que les messages en attente le dépassent, le client est déconnecté.
+        """
+        if client_socket not in self._client_socket_list:
+            # Client déjà déconnecté, par exemple pendant une notification
+            return
+        buffer = self._outgoing.setdefault(client_socket, bytearray())
+        buffer += glosocket.encode_msg(message)
+        if limit is not None and len(buffer) > limit:
+            print(f"Client déconnecté : {len(buffer)} octets en attente")
+            self._close_client(client_socket)
+            return
+        self._flush(client_socket)
+
+    def _flush(self, client_socket: socket.socket) -> None:
+        """
+        Envoie sans bloquer les messages en attente du client.
+        """
+        buffer = self._outgoing[client_socket]
+        client_socket.setblocking(False)
+        try:
+            while buffer:
+                del buffer[:client_socket.send(buffer)]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self._close_client(client_socket)
+            return
+        finally:
+            if client_socket.fileno() != -1:
+                client_socket.setblocking(True)
+        if not buffer:
+            del self._outgoing[client_socket]
+
     def _accept_client(self) -> None:
         """
         Cette méthode accepte une connexion avec un nouveau socket client et
@@ -116,11 +295,39 @@ class Server:
         est également ajouté aux listes appropriées.
         """
         message = self._recv_data(client_socket)
+        if message is None:
+            return
+
+        # Les requêtes des autres nœuds de la grappe ne sont pas authentifiées
+        # par un utilisateur, mais par le secret partagé de la grappe.
+        if message["header"] in (TP4_utils.message_header.CLUSTER_DELIVERY,
+                                 TP4_utils.message_header.CLUSTER_IMPORT_USER,
+                                 TP4_utils.message_header.CLUSTER_REBALANCE):
+            glo_msg = self._process_cluster_request(message)
+            glosocket.send_msg(client_socket, json.dumps({
+                "header": glo_msg["header"],
+                "data": glo_msg["data"]
+            }))
+            return
+
         username: str = message["data"]["username"]
         password: str = message["data"]["password"]
         header = message["header"]
 
         user_datafile_path = self._server_data_path + username
+        # En mode grappe, un compte absent de ce nœud qui appartiendra à un
+        # nœud en cours d'ajout y a été, ou y sera, transféré : ni connexion
+        # ni création de compte avant la fin du rééquilibrage.
+        if self._cluster is not None and not os.path.isdir(user_datafile_path):
+            self._cluster = self._cluster.reload()
+        if self._cluster is not None and not os.path.isdir(user_datafile_path) and \
+                self._cluster.target_owner(username) != self._node_name:
+            glosocket.send_msg(client_socket, json.dumps({
+                "header": TP4_utils.message_header.ERROR,
+                "data": TP4_utils.MIGRATING_ERROR
+            }))
+            return
+
         # Connexion
         if header == TP4_utils.message_header.AUTH_LOGIN:
             # Si le dossier correspondant au username n'existe pas, on retourne une erreur
@@ -146,6 +353,7 @@ class Server:
                 "data": {}
             }))
             self._connected_client_list.append(client_socket)
+            self._client_usernames[client_socket] = username
 
         # Création d'un compte
         if header == TP4_utils.message_header.AUTH_REGISTER:
@@ -184,6 +392,7 @@ class Server:
                 "data": {}
             }))
             self._connected_client_list.append(client_socket)
+            self._client_usernames[client_socket] = username
 
     def _process_client(self, client_socket: socket.socket) -> None:
         """
@@ -192,61 +401,198 @@ class Server:
         Si les données reçues sont invalides, la méthode retourne immédiatement.
         Sinon, la méthode traite la requête et répond au client avec un JSON
         conformant à la classe d’annotation GLO_message.
+
+        Chaque requête est chronométrée par phase pour le journal des requêtes
+        lentes, et profilée si le profilage est activé pour son entête.
         """
-        message = self._recv_data(client_socket)
+        timing = TP4_profiling.RequestTiming()
+        message = self._recv_data(client_socket, timing)
 
         # Si le client s'est déconnecté
         if message is None:
             return
 
         header = message["header"]
+        if self._cluster is not None and not self._check_user_here(client_socket):
+            return
+
+        profile = self._profiler.start(header)
         glo_msg = {}
         try:
             if header is TP4_utils.message_header.INBOX_READING_REQUEST:
-                glo_msg = self._get_subject_list(message["data"]["username"])
+                glo_msg = self._get_subject_list(
+                    message["data"]["username"],
+                    message["data"].get("folder", TP4_utils.DEFAULT_FOLDER))
+            elif header is TP4_utils.message_header.INBOX_SYNC_REQUEST:
+                glo_msg = self._sync_inbox(message["data"])
             elif header is TP4_utils.message_header.INBOX_READING_CHOICE:
-                glo_msg = self._get_email(message["data"])
+                glo_msg = self._get_email(self._client_usernames[client_socket], message["data"])
             elif header is TP4_utils.message_header.EMAIL_SENDING:
                 glo_msg = self._send_email(message["data"])
             elif header is TP4_utils.message_header.STATS_REQUEST:
                 glo_msg = self._get_stats(message["data"]["username"])
-
-            glosocket.send_msg(client_socket, json.dumps({
+            # Les modifications portent toujours sur la boîte de l'utilisateur
+            # connecté, jamais sur celle nommée dans la requête.
+            elif header is TP4_utils.message_header.EMAIL_DELETE:
+                glo_msg = self._delete_email(self._client_usernames[client_socket], message["data"])
+            elif header in (TP4_utils.message_header.EMAIL_MARK_READ,
+                            TP4_utils.message_header.EMAIL_MARK_UNREAD):
+                glo_msg = self._mark_email(
+                    self._client_usernames[client_socket], message["data"],
+                    header is TP4_utils.message_header.EMAIL_MARK_READ)
+            elif header is TP4_utils.message_header.EMAIL_MOVE:
+                glo_msg = self._move_email(self._client_usernames[client_socket], message["data"])
+            elif header is TP4_utils.message_header.PROFILE_REQUEST:
+                glo_msg = self._enable_profiling(client_socket, message["data"])
+            elif header is TP4_utils.message_header.INBOX_SUBSCRIBE:
+                glo_msg = self._subscribe(client_socket)
+            elif header is TP4_utils.message_header.INBOX_UNSUBSCRIBE:
+                self._unsubscribe(client_socket)
+                glo_msg = TP4_utils.GLO_message(
+                    header=TP4_utils.message_header.OK, data={})
+            timing.mark("handler")
+
+            payload = json.dumps({
                 "header": glo_msg["header"],
                 "data": glo_msg["data"]
-            }))
+            })
+            timing.mark("encode")
+            self._queue_msg(client_socket, payload)
+            timing.mark("send")
         except Exception as ex:
             glo_msg["header"] = TP4_utils.message_header.ERROR
             glo_msg["data"] = ex
+        finally:
+            if profile is not None:
+                print(f"Profil écrit : {self._profiler.stop(profile, header)}")
+            self._slow_request_log.record(
+                header, self._client_usernames.get(client_socket), timing)
 
-    def _get_subject_list(self, username: str) -> TP4_utils.GLO_message:
+    def _check_user_here(self, client_socket: socket.socket) -> bool:
+        """
+        Vérifie, en mode grappe, que la boîte de l’utilisateur connecté est
+        toujours sur ce nœud. Pendant son transfert, le client reçoit une
+        erreur; une fois la boîte transférée, il est déconnecté pour qu’il se
+        reconnecte au nouveau nœud par le mandataire. Retourne False si la
+        requête ne doit pas être traitée.
+        """
+        path = os.path.join(self._server_data_path, self._client_usernames[client_socket])
+        if path in self._migrating:
+            self._queue_msg(client_socket, json.dumps({
+                "header": TP4_utils.message_header.ERROR,
+                "data": TP4_utils.MIGRATING_ERROR
+            }))
+            return False
+        if not os.path.isdir(path):
+            self._close_client(client_socket)
+            return False
+        return True
+
+    def _get_subject_list(self, username: str,
+                          folder: str = TP4_utils.DEFAULT_FOLDER) -> TP4_utils.GLO_message:
         """
         Cette méthode récupère la liste des courriels d’un utilisateur.
 
         Le GLO_message retourné contient dans le champ "data" une liste
-        de chaque sujet, sa source et un numéro (commence à 1).
+        de chaque sujet, sa source et un numéro (commence à 1), la liste
+        des numéros correspondants, celle des courriels non lus et l’époque
+        de la boîte, à renvoyer avec les requêtes qui modifient un courriel.
+        Seuls les courriels du dossier demandé qui ne sont pas supprimés
+        sont listés.
         Si le nom d’utilisateur est invalide, le GLO_message retourné
         indique l’erreur au client.
         """
         user_dir_path = os.path.join(self._server_data_path, username)
         if os.path.isdir(user_dir_path):
+            mailbox = self._get_mailbox(username)
             subjects = []
-            for file in os.listdir(user_dir_path):
-                # On valide si le fichier est du bon nom (si c'est un courriel)
-                if re.search(f"^[1-9]+-{username}$", file) is not None:
-                    with open(os.path.join(user_dir_path, file), "r") as f:
-                        content = f.read()
-                        # On récupère le sujet, le numéro et la source
-                        number = file.split('-')[0]
-                        subject = content.split('\n')[2].split(' ')[1]
-                        source = content.split('\n')[0].split(' ')[1]
-                        subjects.append(TP4_utils.SUBJECT_DISPLAY.format(
-                            number=number, subject=subject, source=source))
-            return TP4_utils.GLO_message(header=TP4_utils.message_header.OK, data={"subjects": subjects})
+            unread = []
+            with mailbox.lock:
+                numbers = mailbox.numbers(folder)
+                for number in numbers:
+                    # Le sujet et la source proviennent de l'index de la boîte
+                    source, subject = mailbox.header(number)
+                    subjects.append(TP4_utils.SUBJECT_DISPLAY.format(
+                        number=number, subject=subject, source=source))
+                    if not mailbox.is_read(number):
+                        unread.append(number)
+            return TP4_utils.GLO_message(header=TP4_utils.message_header.OK,
+                                         data={"subjects": subjects, "numbers": numbers,
+                                               "unread": unread, "epoch": mailbox.epoch})
         else:
             return TP4_utils.GLO_message(header=TP4_utils.message_header.ERROR, data={})
 
-    def _get_email(self, data: dict) -> TP4_utils.GLO_message:
+    def _sync_inbox(self, data: dict) -> TP4_utils.GLO_message:
+        """
+        Cette méthode retourne les changements d’un dossier depuis la dernière
+        synchronisation du client.
+
+        Le client envoie l’époque («epoch») et la séquence de modification
+        («modseq») reçues lors de sa dernière synchronisation. Le GLO_message
+        retourné contient dans le champ «data»:
+        - «epoch» et «modseq», l’état actuel de la boîte,
+        - «not_modified», vrai si rien n’a changé depuis,
+        - «full», vrai si le client doit remplacer toute sa copie locale,
+        - «entries», le sujet, le numéro et l’état de lecture des courriels
+            ajoutés ou modifiés,
+        - «removed», les numéros des courriels retirés du dossier.
+        """
+        username = data["username"]
+        folder = data.get("folder", TP4_utils.DEFAULT_FOLDER)
+        if not os.path.isdir(os.path.join(self._server_data_path, username)):
+            return TP4_utils.GLO_message(header=TP4_utils.message_header.ERROR, data={})
+
+        try:
+            modseq = int(data.get("modseq", -1))
+        except (TypeError, ValueError):
+            return TP4_utils.GLO_message(
+                header=TP4_utils.message_header.ERROR,
+                data="La séquence de modification est invalide."
+            )
+
+        mailbox = self._get_mailbox(username)
+        with mailbox.lock:
+            changed = None
+            if data.get("epoch") == mailbox.epoch:
+                changed = mailbox.changes_since(modseq)
+
+            if changed is not None and not changed:
+                # Rien n'a changé : inutile de lire le dossier sur le disque
+                return TP4_utils.GLO_message(
+                    header=TP4_utils.message_header.OK,
+                    data={"epoch": mailbox.epoch, "modseq": mailbox.modseq,
+                          "not_modified": True, "full": False,
+                          "entries": [], "removed": []}
+                )
+
+            if changed is None:
+                numbers = mailbox.numbers(folder)
+                removed = []
+            else:
+                # Un courriel modifié qui n'est plus dans le dossier en a été retiré
+                in_folder = set(mailbox.numbers(folder))
+                numbers = sorted(number for number in changed if number in in_folder)
+                removed = sorted(number for number in changed if number not in in_folder)
+
+            entries = []
+            for number in numbers:
+                source, subject = mailbox.header(number)
+                entries.append({
+                    "number": number,
+                    "subject": TP4_utils.SUBJECT_DISPLAY.format(
+                        number=number, subject=subject, source=source),
+                    "unread": not mailbox.is_read(number)
+                })
+
+            return TP4_utils.GLO_message(
+                header=TP4_utils.message_header.OK,
+                data={"epoch": mailbox.epoch, "modseq": mailbox.modseq,
+                      "not_modified": False,
+                      "full": changed is None,
+                      "entries": entries, "removed": removed}
+            )
+
+    def _get_email(self, username: str, data: dict) -> TP4_utils.GLO_message:
         """
         Cette méthode récupère le contenu du courriel choisi par l’utilisateur.
 
@@ -254,27 +600,31 @@ class Server:
         en chaine de caractère du courriel chargé depuis le fichier à l’aide du
         module email. Si le choix ou le nom d’utilisateur est incorrect, le
         GLO_message retourné indique l’erreur au client.
-        if(usernameExists):
+        Le courriel consulté, tiré de la boîte de l’utilisateur connecté
+        «username», est marqué comme lu. Si la requête contient l’époque de
+        la liste consultée, elle doit correspondre à celle de la boîte.
         """
 
-        username = data["username"]
-        choix = data["choice"]
-        user_dir_path = os.path.join(self._server_data_path, username)
-        filename = choix + '-' + username
-
-        if os.path.isfile(os.path.join(user_dir_path, filename)):
-            with open(os.path.join(user_dir_path, filename)) as f:
-                formatted_content = f.read().split('\n')
-                source = formatted_content[0].split(' ')[1]
-                destination = formatted_content[1].split(' ')[1]
-                subject = formatted_content[2].split(' ')[1]
-                content = '\n'.join(formatted_content[6:])
+        mailbox = self._get_mailbox(username)
+        number = self._parse_choice(data)
 
+        with mailbox.lock:
+            if "epoch" in data and data["epoch"] != mailbox.epoch:
                 return TP4_utils.GLO_message(
-                    header=TP4_utils.message_header.OK,
-                    data={"source": source, "destination": destination,
-                          "subject": subject, "content": content}
+                    header=TP4_utils.message_header.ERROR,
+                    data=TP4_utils.STALE_EPOCH_ERROR
                 )
+            if number is not None and mailbox.exists(number):
+                email_data = TP4_mailbox.parse_email(mailbox.read_email(number))
+                mailbox.set_read(number, True)
+            else:
+                email_data = None
+
+        if email_data is not None:
+            return TP4_utils.GLO_message(
+                header=TP4_utils.message_header.OK,
+                data=email_data
+            )
         else:
             return TP4_utils.GLO_message(
                 header=TP4_utils.message_header.ERROR,
@@ -296,8 +646,16 @@ class Server:
         Le GLO_message retourné contient indique si l’envoi a réussi
         ou non.
         """
-        adresse_source = email_string.split("\n")[0].split(" ")[1]
-        adresse_destination = email_string.split("\n")[1].split(" ")[1]
+        # Le courriel doit avoir le format attendu avant d'être écrit dans une boîte
+        try:
+            parsed = TP4_mailbox.parse_email(email_string)
+        except ValueError:
+            return TP4_utils.GLO_message(
+                header=TP4_utils.message_header.ERROR,
+                data="Le courriel n'a pas le format attendu."
+            )
+        adresse_source = parsed["source"]
+        adresse_destination = parsed["destination"]
 
         # On vérifie si les adresses courriels sont valides
         if (re.search(r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)", adresse_source) is None):
@@ -324,29 +682,16 @@ class Server:
         destination_domain = adresse_destination.split("@")[1]
         if destination_domain == TP4_utils.SERVER_DOMAIN:
             username_destination = adresse_destination.split("@")[0]
-            dir_path = os.path.join(
-                self._server_data_path, username_destination)
-
-            # Si l'utilisateur correspondant à l'adresse de destination est un utilisateur invalide
-            if not os.path.isdir(dir_path):
-                dir_path = self._server_lost_dir + username_destination
-                if not os.path.isdir(dir_path):
-                    os.mkdir(dir_path)
-
-                message = TP4_utils.GLO_message(
-                    header=TP4_utils.message_header.ERROR, data="L'adresse de destination n'existe pas")
 
-            # trouver le numeros du courriel et ne pas compter le fichier du mot de passe
-            number_of_file_in_dir = len(os.listdir(dir_path)) - 1
-            print(
-                f"Number of file in destination user dir: {number_of_file_in_dir}")
-            filename = str(number_of_file_in_dir + 1) + \
-                '-' + username_destination
+            # En mode grappe, le courriel d'un utilisateur d'un autre nœud est
+            # mis dans la file d'envoi vers le nœud propriétaire.
+            if self._cluster is not None and \
+                    self._cluster.owner(username_destination) != self._node_name:
+                self._outbox.put(username_destination, email_string)
+                self._outbox_event.set()
+                return message
 
-            with open(os.path.join(dir_path, filename), "w") as f:
-                f.write(email_string)
-
-            return message
+            return self._deliver_local(username_destination, email_string)
 
         # On essaie de se connecter au serveur smtp distant pour envoyer le courriel externe
         destination_domain = adresse_destination.split("@")[1]
@@ -369,13 +714,518 @@ class Server:
                 data="La connexion au serveur SMTP n'a pas pu être établis"
             )
 
+    def _deliver_local(self, username_destination: str, email_string: str) -> TP4_utils.GLO_message:
+        """
+        Cette méthode écrit un courriel dans la boîte d’un utilisateur de ce
+        serveur, ou dans le dossier LOST si l’utilisateur n’existe pas, puis
+        notifie les clients abonnés.
+        """
+        if self._username_verificator.match(username_destination) is None:
+            return TP4_utils.GLO_message(
+                header=TP4_utils.message_header.ERROR,
+                data="L'adresse destination n'est pas une adresse courriel valide."
+            )
+
+        message = TP4_utils.GLO_message(
+            header=TP4_utils.message_header.OK, data="Le courriel a été envoyé avec succès.")
+        dir_path = os.path.join(
+            self._server_data_path, username_destination)
+        lost = False
+
+        # Si l'utilisateur correspondant à l'adresse de destination est un utilisateur invalide
+        if not os.path.isdir(dir_path):
+            # En mode grappe, sa boîte a peut-être été transférée au nœud en
+            # cours d'ajout qui en deviendra propriétaire.
+            if self._cluster is not None and \
+                    self._cluster.target_owner(username_destination) != self._node_name:
+                self._outbox.put(username_destination, email_string)
+                self._outbox_event.set()
+                return message
+            lost = True
+            message = TP4_utils.GLO_message(
+                header=TP4_utils.message_header.ERROR, data=TP4_utils.UNKNOWN_DESTINATION_ERROR)
+
+        # Le numéro du courriel est attribué par la boîte, qui tient compte des pierres tombales
+        mailbox = self._get_mailbox(username_destination, lost)
+        with mailbox.lock:
+            if self._outbox is not None and (mailbox.path in self._migrating or
+                                             not lost and not os.path.isdir(mailbox.path)):
+                # La boîte est en cours de transfert, ou vient d'être
+                # transférée : le courriel est remis par la file d'envoi.
+                self._outbox.put(username_destination, email_string)
+                self._outbox_event.set()
+                return message
+            number = mailbox.deliver(email_string)
+        if not lost:
+            self._notify_subscribers(username_destination, mailbox, number)
+
+        return message
+
+    def _process_cluster_request(self, message: TP4_utils.GLO_message) -> TP4_utils.GLO_message:
+        """
+        Cette méthode traite les requêtes des autres nœuds de la grappe et de
+        l’outil de rééquilibrage, après avoir vérifié le secret partagé. Une
+        requête invalide est refusée sans interrompre le serveur.
+        """
+        data = message["data"]
+        # Les secrets sont comparés en octets : compare_digest refuse les
+        # chaines qui contiennent des caractères non ASCII.
+        if self._cluster is None or not isinstance(data, dict) or \
+                not isinstance(data.get("secret"), str) or \
+                not hmac.compare_digest(data["secret"].encode(), self._cluster.secret.encode()):
+            return TP4_utils.GLO_message(
+                header=TP4_utils.message_header.ERROR,
+                data="Requête de grappe refusée."
+            )
+
+        header = message["header"]
+        try:
+            if header is TP4_utils.message_header.CLUSTER_DELIVERY:
+                return self._receive_delivery(data["username"], data["email"])
+            elif header is TP4_utils.message_header.CLUSTER_IMPORT_USER:
+                return self._import_user(data)
+            else:
+                return self._rebalance(data)
+        except (KeyError, TypeError, ValueError, OSError) as ex:
+            print(f"Requête de grappe {header.name} en échec : {ex!r}")
+            return TP4_utils.GLO_message(
+                header=TP4_utils.message_header.ERROR,
+                data="Requête de grappe invalide."
+            )
+
+    def _receive_delivery(self, username: str, email_string: str) -> TP4_utils.GLO_message:
+        """
+        Cette méthode écrit un courriel transmis par un autre nœud.
+
+        Si ce nœud n’est ni le propriétaire de l’utilisateur, ni celui vers
+        lequel sa boîte est transférée, par exemple parce que l’expéditeur
+        utilise une configuration plus récente, la configuration est relue
+        et le courriel est mis dans la file d’envoi vers le véritable
+        propriétaire plutôt que d’être perdu ici.
+        """
+        if not isinstance(username, str) or not isinstance(email_string, str):
+            raise TypeError("Le nom d'utilisateur et le courriel doivent être des chaines.")
+
+        owners = (self._cluster.owner(username), self._cluster.target_owner(username))
+        if self._node_name not in owners:
+            self._cluster = self._cluster.reload()
+            owners = (self._cluster.owner(username), self._cluster.target_owner(username))
+            if self._node_name not in owners:
+                self._outbox.put(username, email_string)
+                self._outbox_event.set()
+                return TP4_utils.GLO_message(
+                    header=TP4_utils.message_header.OK,
+                    data="Le courriel a été transmis au nœud propriétaire."
+                )
+
+        return self._deliver_local(username, email_string)
+
+    def _forward_loop(self) -> NoReturn:
+        """
+        Boucle du fil qui transmet les courriels de la file d’envoi à leur
+        nœud propriétaire.
+
+        Les courriels d’un même nœud sont transmis dans leur ordre d’arrivée.
+        Un nœud injoignable, ou qui refuse un courriel, est ignoré jusqu’à la
+        tentative suivante sans retarder les autres nœuds; ses courriels
+        restent sur le disque. Un courriel n’est retiré de la file que si le
+        nœud l’a écrit, dans la boîte de l’utilisateur ou dans le dossier LOST.
+        """
+        while True:
+            self._outbox_event.wait(TP4_utils.CLUSTER_RETRY_INTERVAL)
+            self._outbox_event.clear()
+            try:
+                self._forward_pending()
+            except (OSError, ValueError, KeyError) as ex:
+                print(f"Transmission de la file d'envoi interrompue : {ex!r}")
+
+    def _forward_pending(self) -> None:
+        """
+        Fait une passe de transmission sur les courriels de la file d’envoi.
+        """
+        # Le propriétaire est recalculé à chaque passe, au cas où
+        # l'utilisateur aurait été déplacé entre-temps.
+        cluster = self._cluster.reload()
+        self._cluster = cluster
+        skipped_nodes: set[str] = set()
+        for filename, username, email_string in self._outbox.pending():
+            node = cluster.owner(username)
+            if node == self._node_name:
+                # Courriel mis de côté pendant le transfert de la boîte : il
+                # est remis après le transfert, au nœud qui détient la boîte.
+                path = os.path.join(self._server_data_path, username)
+                if path in self._migrating:
+                    continue
+                if not os.path.isdir(path):
+                    node = cluster.target_owner(username)
+            if node in skipped_nodes:
+                continue
+            try:
+                response = TP4_cluster.request(cluster.address(node), {
+                    "header": TP4_utils.message_header.CLUSTER_DELIVERY,
+                    "data": {"secret": cluster.secret,
+                             "username": username, "email": email_string}
+                }, timeout=TP4_utils.CLUSTER_REQUEST_TIMEOUT)
+            except (OSError, ValueError) as ex:
+                print(f"Le nœud {node} est injoignable : {ex}")
+                skipped_nodes.add(node)
+                continue
+            if response is None:
+                skipped_nodes.add(node)
+                continue
+            if response["header"] == TP4_utils.message_header.ERROR and \
+                    response["data"] != TP4_utils.UNKNOWN_DESTINATION_ERROR:
+                print(f"Transfert de {filename} vers {node} refusé : {response['data']}")
+                skipped_nodes.add(node)
+                continue
+            self._outbox.remove(filename)
+
+    def _rebalance(self, data: dict) -> TP4_utils.GLO_message:
+        """
+        Cette méthode démarre le rééquilibrage si la requête le demande
+        («start», vrai par défaut) et qu’il n’est pas déjà en cours, puis
+        retourne sa progression sans attendre : «running», «moved» (boîtes
+        transférées) et «failed» (échecs).
+
+        Le rééquilibrage s’exécute dans un fil pour que le nœud continue de
+        servir ses clients pendant les transferts.
+        """
+        if data.get("start", True) and not self._rebalance_progress["running"]:
+            self._cluster = TP4_cluster.ClusterConfig(self._cluster.path)
+            self._rebalance_progress = {"running": True, "moved": 0, "failed": 0}
+            self._rebalance_thread = threading.Thread(target=self._rebalance_loop, daemon=True)
+            self._rebalance_thread.start()
+        return TP4_utils.GLO_message(
+            header=TP4_utils.message_header.OK,
+            data=dict(self._rebalance_progress)
+        )
+
+    def _rebalance_loop(self) -> None:
+        """
+        Boucle du fil de rééquilibrage : transfère au nœud propriétaire chaque
+        utilisateur et chaque dossier LOST qui n’appartiennent plus à ce nœud.
+        """
+        progress = self._rebalance_progress
+        try:
+            for root, lost in ((self._server_data_path, False), (self._server_lost_dir, True)):
+                for username in sorted(os.listdir(root)):
+                    if not os.path.isdir(os.path.join(root, username)):
+                        continue
+                    node = self._cluster.target_owner(username)
+                    if node == self._node_name:
+                        continue
+                    try:
+                        migrated = self._migrate_user(username, lost, node)
+                    except OSError as ex:
+                        print(f"Transfert de {os.path.join(root, username)} impossible : {ex}")
+                        migrated = False
+                    progress["moved" if migrated else "failed"] += 1
+        finally:
+            progress["running"] = False
+            print(f"Rééquilibrage terminé : {progress['moved']} boîte(s) transférée(s), "
+                  f"{progress['failed']} échec(s).")
+
+    def _migrate_user(self, username: str, lost: bool, node: str) -> bool:
+        """
+        Transfère tous les fichiers de la boîte au nœud «node», puis la
+        supprime de ce nœud. Appelée par le fil de rééquilibrage.
+
+        Les fichiers sont copiés sous le verrou de la boîte, mais le verrou
+        n’est pas détenu pendant l’envoi : la boîte est plutôt marquée comme
+        en cours de transfert, ce qui suspend ses modifications et reporte
+        ses livraisons à la file d’envoi. Les sessions de l’utilisateur sont
+        fermées à leur prochaine requête pour qu’elles se reconnectent au
+        nouveau nœud par le mandataire.
+        """
+        mailbox = self._get_mailbox(username, lost)
+        with mailbox.lock:
+            self._migrating.add(mailbox.path)
+            files = {}
+            try:
+                for filename in os.listdir(mailbox.path):
+                    # Les fichiers temporaires d'une écriture en cours sont ignorés
+                    if filename.startswith(".") and filename != TP4_utils.MAILBOX_STATE_FILE:
+                        continue
+                    with open(os.path.join(mailbox.path, filename), "r") as f:
+                        files[filename] = f.read()
+            except OSError:
+                self._migrating.discard(mailbox.path)
+                raise
+
+        try:
+            try:
+                response = TP4_cluster.request(self._cluster.address(node), {
+                    "header": TP4_utils.message_header.CLUSTER_IMPORT_USER,
+                    "data": {"secret": self._cluster.secret, "username": username,
+                             "lost": lost, "files": files}
+                }, timeout=30)
+            except (OSError, ValueError) as ex:
+                print(f"Transfert de {mailbox.path} vers {node} impossible : {ex}")
+                return False
+            if response is None or response["header"] == TP4_utils.message_header.ERROR:
+                print(f"Transfert de {mailbox.path} vers {node} refusé : "
+                      f"{response['data'] if response is not None else 'aucune réponse'}")
+                return False
+
+            with mailbox.lock:
+                shutil.rmtree(mailbox.path)
+                with self._mailboxes_lock:
+                    self._mailboxes.pop(mailbox.path, None)
+        finally:
+            self._migrating.discard(mailbox.path)
+        print(f"Boîte {mailbox.path} transférée vers {node}")
+        return True
+
+    def _import_user(self, data: dict) -> TP4_utils.GLO_message:
+        """
+        Cette méthode reçoit une boîte transférée par un autre nœud.
+
+        Un utilisateur est recréé tel quel et ne doit pas déjà exister sur ce
+        nœud; les courriels reçus ici pour lui avant son transfert, dans le
+        dossier LOST, sont ajoutés à sa boîte. Les courriels d’un dossier
+        LOST sont plutôt ajoutés à la boîte de l’utilisateur s’il existe sur
+        ce nœud, sinon à la boîte LOST locale, qui peut déjà exister.
+        """
+        username = data["username"]
+        files: dict[str, str] = data["files"]
+        # Seuls les fichiers d'une boîte sont acceptés : les courriels, le
+        # mot de passe et le fichier d'état.
+        pattern = re.compile(f"^([0-9]+)-{re.escape(username)}$") \
+            if isinstance(username, str) else None
+        if pattern is None or self._username_verificator.match(username) is None or \
+                not isinstance(files, dict) or \
+                any(not isinstance(content, str) for content in files.values()) or \
+                any(pattern.match(filename) is None and filename not in
+                    (TP4_utils.PASSWORD_FILE, TP4_utils.MAILBOX_STATE_FILE)
+                    for filename in files):
+            return TP4_utils.GLO_message(
+                header=TP4_utils.message_header.ERROR,
+                data="Le nom d'utilisateur ou de fichier est invalide."
+            )
+
+        user_dir_path = os.path.join(self._server_data_path, username)
+        if data["lost"]:
+            mailbox = self._get_mailbox(username, not os.path.isdir(user_dir_path))
+            numbered = [(int(match.group(1)), filename) for filename in files
+                        if (match := pattern.match(filename)) is not None]
+            for _, filename in sorted(numbered):
+                mailbox.deliver(files[filename])
+        else:
+            if os.path.isdir(user_dir_path):
+                return TP4_utils.GLO_message(
+                    header=TP4_utils.message_header.ERROR,
+                    data="L'utilisateur existe déjà sur ce nœud."
+                )
+            os.mkdir(user_dir_path)
+            for filename, content in files.items():
+                with open(os.path.join(user_dir_path, filename), "w") as f:
+                    f.write(content)
+            with self._mailboxes_lock:
+                self._mailboxes.pop(user_dir_path, None)
+            if os.path.isdir(os.path.join(self._server_lost_dir, username)):
+                self._merge_lost(username)
+
+        return TP4_utils.GLO_message(header=TP4_utils.message_header.OK, data={})
+
+    def _merge_lost(self, username: str) -> None:
+        """
+        Ajoute à la boîte de l’utilisateur les courriels de son dossier LOST,
+        dans leur ordre d’arrivée, puis supprime ce dossier.
+        """
+        mailbox = self._get_mailbox(username)
+        lost_mailbox = self._get_mailbox(username, True)
+        with lost_mailbox.lock:
+            for number in lost_mailbox.numbers(None):
+                mailbox.deliver(lost_mailbox.read_email(number))
+            shutil.rmtree(lost_mailbox.path)
+            with self._mailboxes_lock:
+                self._mailboxes.pop(lost_mailbox.path, None)
+
+    def _subscribe(self, client_socket: socket.socket) -> TP4_utils.GLO_message:
+        """
+        Cette méthode abonne le client aux notifications de nouveaux courriels.
+
+        Après l’abonnement, chaque courriel livré dans la boîte de l’utilisateur
+        lui est signalé par un message NEW_EMAIL_NOTIFICATION, sans qu’il ait
+        à redemander la liste des courriels.
+        """
+        username = self._client_usernames.get(client_socket)
+        if username is None:
+            return TP4_utils.GLO_message(
+                header=TP4_utils.message_header.ERROR,
+                data="L'utilisateur n'est pas connecté."
+            )
+        self._subscribers.setdefault(username, set()).add(client_socket)
+        return TP4_utils.GLO_message(header=TP4_utils.message_header.OK, data={})
+
+    def _unsubscribe(self, client_socket: socket.socket) -> None:
+        """
+        Retire le client des abonnés aux notifications, s’il l’était.
+        """
+        username = self._client_usernames.get(client_socket)
+        subscribers = self._subscribers.get(username)
+        if subscribers is not None:
+            subscribers.discard(client_socket)
+            if not subscribers:
+                del self._subscribers[username]
+
+    def _notify_subscribers(self, username: str, mailbox: TP4_mailbox.Mailbox, number: int) -> None:
+        """
+        Met en attente une notification du courriel «number» pour chaque
+        client abonné de l’utilisateur. L’envoi ne bloque jamais la boucle
+        principale : un abonné qui ne lit pas ses notifications est
+        déconnecté lorsque ses messages en attente dépassent la limite.
+        """
+        subscribers = self._subscribers.get(username)
+        if not subscribers:
+            return
+
+        try:
+            source, subject = mailbox.header(number)
+        except ValueError:
+            return
+        notification = json.dumps({
+            "header": TP4_utils.message_header.NEW_EMAIL_NOTIFICATION,
+            "data": {"number": number, "source": source, "subject": subject}
+        })
+        for subscriber in list(subscribers):
+            self._queue_msg(subscriber, notification, TP4_utils.OUTGOING_BUFFER_LIMIT)
+
+    def _parse_choice(self, data: dict) -> Optional[int]:
+        """
+        Convertit le numéro de courriel choisi par l’utilisateur en entier.
+        Retourne None si le choix n’est pas un numéro.
+        """
+        choix = str(data.get("choice", ""))
+        if re.search(r"^[0-9]+$", choix) is None:
+            return None
+        return int(choix)
+
+    def _update_email(self, username: str, data: dict,
+                      update: Callable[[TP4_mailbox.Mailbox, int], bool]) -> Optional[TP4_utils.GLO_message]:
+        """
+        Applique «update» au courriel choisi dans la boîte de l’utilisateur
+        connecté «username», sous le verrou de la boîte. Le champ «username»
+        de la requête est ignoré. Retourne le GLO_message d’erreur à transmettre au client,
+        ou None si la modification a réussi.
+
+        La requête doit contenir l’époque («epoch») de la liste consultée par
+        le client : un compactage a pu renuméroter les courriels depuis, et le
+        numéro choisi désignerait alors un autre courriel.
+        """
+        mailbox = self._get_mailbox(username)
+        number = self._parse_choice(data)
+        with mailbox.lock:
+            if mailbox.path in self._migrating:
+                return TP4_utils.GLO_message(
+                    header=TP4_utils.message_header.ERROR,
+                    data=TP4_utils.MIGRATING_ERROR
+                )
+            if data.get("epoch") != mailbox.epoch:
+                return TP4_utils.GLO_message(
+                    header=TP4_utils.message_header.ERROR,
+                    data=TP4_utils.STALE_EPOCH_ERROR
+                )
+            if number is None or not update(mailbox, number):
+                return TP4_utils.GLO_message(
+                    header=TP4_utils.message_header.ERROR,
+                    data="Le numéro du courriel choisi est invalide."
+                )
+        return None
+
+    def _delete_email(self, username: str, data: dict) -> TP4_utils.GLO_message:
+        """
+        Cette méthode supprime le courriel choisi par l’utilisateur.
+
+        La suppression ajoute seulement une pierre tombale : le fichier et
+        la numérotation des autres courriels restent inchangés jusqu’au
+        prochain compactage.
+        """
+        error = self._update_email(username, data, lambda mailbox, number: mailbox.delete(number))
+        if error is not None:
+            return error
+        return TP4_utils.GLO_message(
+            header=TP4_utils.message_header.OK,
+            data="Le courriel a été supprimé."
+        )
+
+    def _mark_email(self, username: str, data: dict, read: bool) -> TP4_utils.GLO_message:
+        """
+        Cette méthode marque le courriel choisi par l’utilisateur comme lu
+        ou non lu.
+        """
+        error = self._update_email(username, data, lambda mailbox, number: mailbox.set_read(number, read))
+        if error is not None:
+            return error
+        return TP4_utils.GLO_message(
+            header=TP4_utils.message_header.OK,
+            data="Le courriel a été marqué comme lu." if read
+            else "Le courriel a été marqué comme non lu."
+        )
+
+    def _move_email(self, username: str, data: dict) -> TP4_utils.GLO_message:
+        """
+        Cette méthode déplace le courriel choisi par l’utilisateur vers le
+        dossier indiqué dans le champ «folder».
+        """
+        folder = str(data.get("folder", "")).strip()
+        if not folder or re.search(r"\s", folder) is not None:
+            return TP4_utils.GLO_message(
+                header=TP4_utils.message_header.ERROR,
+                data="Le nom du dossier ne doit pas être vide ni contenir d'espace."
+            )
+
+        error = self._update_email(username, data, lambda mailbox, number: mailbox.move(number, folder))
+        if error is not None:
+            return error
+        return TP4_utils.GLO_message(
+            header=TP4_utils.message_header.OK,
+            data=f"Le courriel a été déplacé vers {folder}."
+        )
+
+    def _enable_profiling(self, client_socket: socket.socket, data: dict) -> TP4_utils.GLO_message:
+        """
+        Cette méthode active le profilage des «count» prochaines requêtes
+        portant l’entête «header» (par son nom, par exemple
+        «INBOX_READING_REQUEST»). Seuls les administrateurs peuvent la
+        demander.
+        """
+        if self._client_usernames.get(client_socket) not in self._admin_users:
+            return TP4_utils.GLO_message(
+                header=TP4_utils.message_header.ERROR,
+                data="Cette requête est réservée aux administrateurs."
+            )
+
+        try:
+            header = TP4_utils.message_header[data["header"]]
+            count = int(data.get("count", 1))
+        except (KeyError, ValueError, TypeError):
+            return TP4_utils.GLO_message(
+                header=TP4_utils.message_header.ERROR,
+                data="L'entête ou le nombre de requêtes est invalide."
+            )
+
+        self._profiler.enable(header, count)
+        return TP4_utils.GLO_message(
+            header=TP4_utils.message_header.OK,
+            data=f"Profilage activé pour {count} requête(s) {header.name}."
+        )
+
+    def _handle_profile_signal(self, signum: int, frame) -> None:
+        """
+        Active le profilage configuré pour le signal SIGUSR1.
+        """
+        header, count = self._signal_profile
+        self._profiler.enable(header, count)
+        print(f"Profilage activé pour {count} requête(s) {header.name}.")
+
     def _get_stats(self, username: str) -> TP4_utils.GLO_message:
         """
         Cette méthode récupère les statistiques liées à un utilisateur.
 
         Le GLO_message retourné contient dans le champ «data» les entrées:
         - «count», avec le nombre de courriels,
-        - «folder_size», avec la taille totale du dossier en octets.
+        - «size», avec la taille totale des courriels en octets.
         Si le nom d’utilisateur est invalide, le GLO_message retourné
         indique l’erreur au client.
         """
@@ -389,30 +1239,175 @@ class Server:
                 data="L'utilisateur n'existe pas."
             )
 
-        # Compte le nombre de fichiers dans le dossier de l'utilisateur (en excluant le fichier du mot de passe)
-        nombre_de_fichier = -1
-        for path in os.listdir(user_dir_path):
-            nombre_de_fichier += 1
-
-        # Compte la taille du dossier de l'utilisateur
-        taille_du_dossier = sum(
-            d.stat().st_size for d in os.scandir(user_dir_path) if d.is_file())
+        # Le nombre et la taille portent sur les mêmes courriels : ceux qui ne
+        # sont pas supprimés, tous dossiers confondus
+        mailbox = self._get_mailbox(username)
+        with mailbox.lock:
+            numbers = mailbox.numbers(None)
+            nombre_de_fichier = len(numbers)
+            taille_du_dossier = sum(mailbox.size(number) for number in numbers)
 
         return TP4_utils.GLO_message(
             header=TP4_utils.message_header.OK,
             data={"count": nombre_de_fichier, "size": taille_du_dossier}
         )
 
+    def _compact_mailboxes(self) -> None:
+        """
+        Effectue une passe de compactage sur toutes les boîtes de courriels.
+
+        Pour chaque boîte, les politiques de rétention sont d’abord appliquées,
+        puis les fichiers supprimés sont retirés et la numérotation est
+        compactée. Le verrou d’une boîte n’est détenu que le temps de la
+        traiter, la boucle principale n’est donc jamais bloquée longtemps.
+        """
+        for root, lost in ((self._server_data_path, False), (self._server_lost_dir, True)):
+            if not os.path.isdir(root):
+                continue
+            retention_days = self._retention_days.get(root)
+            for username in os.listdir(root):
+                if not os.path.isdir(os.path.join(root, username)):
+                    continue
+                mailbox = self._get_mailbox(username, lost)
+                if retention_days is not None:
+                    mailbox.expire(retention_days)
+                removed = mailbox.compact()
+                if removed:
+                    print(f"Compactage de {mailbox.path} : {removed} courriel(s) retiré(s)")
+
+    def _scan_mailboxes(self, mailboxes: list[tuple[str, str]]) -> None:
+        """
+        Vérifie en parallèle les boîtes présentes au démarrage.
+
+        Le serveur répond aux clients pendant la vérification : le résultat
+        d’une boîte déjà chargée à la demande d’un client est ignoré, puisque
+        cette boîte a été vérifiée lors de son chargement.
+        """
+        for result in TP4_fsck.scan(mailboxes, self._scan_workers, TP4_fsck.print_progress):
+            path = os.path.join(result["root"], result["username"])
+            with self._mailboxes_lock:
+                if path in self._unchecked_mailboxes:
+                    self._load_mailbox(path, result["username"], result)
+
+        with self._mailboxes_lock:
+            self._unchecked_mailboxes.clear()
+
+    def _compaction_loop(self) -> NoReturn:
+        """
+        Boucle du fil de compactage en arrière-plan.
+        """
+        while True:
+            time.sleep(self._compaction_interval)
+            try:
+                self._compact_mailboxes()
+            except OSError as ex:
+                print(f"Erreur lors du compactage : {ex}")
+
     def run(self) -> NoReturn:
         """
-        Appelle la méthode _main_loop en boucle jusqu’à la fin du programme.
+        Installe le signal de profilage, démarre les fils de vérification, de
+        compactage et, en mode grappe, de transmission aux autres nœuds, puis
+        appelle la méthode _main_loop en boucle jusqu’à la fin du programme.
         """
+        if hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, self._handle_profile_signal)
+        if self._outbox is not None:
+            threading.Thread(target=self._forward_loop, daemon=True).start()
+            # Les courriels restés dans la file au dernier arrêt sont transmis
+            self._outbox_event.set()
+        if self._startup_scan:
+            self._startup_scan = False
+            # Les boîtes à vérifier sont connues avant de servir le premier client
+            mailboxes = TP4_fsck.list_mailboxes(
+                [self._server_data_path, self._server_lost_dir])
+            with self._mailboxes_lock:
+                self._unchecked_mailboxes = {
+                    os.path.join(root, username) for root, username in mailboxes}
+            threading.Thread(target=self._scan_mailboxes,
+                             args=(mailboxes,), daemon=True).start()
+        if self._compaction_thread is None and self._compaction_interval > 0:
+            self._compaction_thread = threading.Thread(
+                target=self._compaction_loop, daemon=True)
+            self._compaction_thread.start()
         while True:
             self._main_loop()
 
 
 def main() -> NoReturn:
-    Server().run()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--compaction-interval", dest="compaction_interval",
+                        type=float, action="store", default=TP4_utils.COMPACTION_INTERVAL,
+                        help="secondes entre deux compactages (0 pour désactiver)")
+    parser.add_argument("--lost-retention-days", dest="lost_retention_days",
+                        type=int, action="store",
+                        default=TP4_utils.RETENTION_DAYS[TP4_utils.SERVER_LOST_DIR],
+                        help="jours avant l'expiration des courriels du dossier LOST")
+    parser.add_argument("--data-retention-days", dest="data_retention_days",
+                        type=int, action="store",
+                        default=TP4_utils.RETENTION_DAYS[TP4_utils.SERVER_DATA_DIR],
+                        help="jours avant l'expiration des courriels des utilisateurs")
+    parser.add_argument("--fsck", dest="fsck", action="store_true",
+                        help="vérifier les boîtes hors ligne puis quitter")
+    parser.add_argument("--no-startup-scan", dest="startup_scan", action="store_false",
+                        help="ne pas vérifier les boîtes au démarrage")
+    parser.add_argument("--scan-workers", dest="scan_workers", type=int, action="store",
+                        help="nombre de processus pour la vérification")
+    parser.add_argument("--slow-request-threshold", dest="slow_request_threshold",
+                        type=float, action="store", default=TP4_utils.SLOW_REQUEST_THRESHOLD,
+                        help="secondes à partir desquelles une requête est journalisée (négatif pour désactiver)")
+    parser.add_argument("--slow-request-log", dest="slow_request_log", type=str, action="store",
+                        help="fichier du journal des requêtes lentes (terminal par défaut)")
+    parser.add_argument("--profile-dir", dest="profile_dir", type=str, action="store",
+                        default=TP4_utils.PROFILE_DIR, help="dossier des fichiers pstats")
+    parser.add_argument("--profile-header", dest="profile_header", type=str, action="store",
+                        default=TP4_utils.message_header.INBOX_READING_REQUEST.name,
+                        help="entête profilée à la réception de SIGUSR1")
+    parser.add_argument("--profile-count", dest="profile_count", type=int, action="store",
+                        default=10, help="nombre de requêtes profilées à la réception de SIGUSR1")
+    parser.add_argument("--admin", dest="admin_users", type=str, action="append",
+                        help="utilisateur autorisé à activer le profilage (répétable)")
+    parser.add_argument("--host", dest="host", type=str, action="store",
+                        default="127.0.0.1", help="adresse d'écoute")
+    parser.add_argument("--port", dest="port", type=int, action="store",
+                        default=TP4_utils.SOCKET_PORT, help="port d'écoute")
+    parser.add_argument("--workdir", dest="workdir", type=str, action="store",
+                        help="dossier de travail contenant les données du serveur")
+    parser.add_argument("--cluster", dest="cluster", type=str, action="store",
+                        help="fichier de configuration de la grappe")
+    parser.add_argument("--node", dest="node", type=str, action="store",
+                        help="nom de ce nœud dans la configuration de la grappe")
+    args = parser.parse_args()
+
+    # Le chemin de la configuration est résolu avant de changer de dossier
+    cluster_config = os.path.abspath(args.cluster) if args.cluster is not None else None
+    if args.workdir is not None:
+        os.makedirs(args.workdir, exist_ok=True)
+        os.chdir(args.workdir)
+
+    if args.fsck:
+        TP4_fsck.fsck([TP4_utils.SERVER_DATA_DIR, TP4_utils.SERVER_LOST_DIR],
+                      args.scan_workers)
+        exit(0)
+
+    Server(
+        compaction_interval=args.compaction_interval,
+        retention_days={
+            TP4_utils.SERVER_DATA_DIR: args.data_retention_days,
+            TP4_utils.SERVER_LOST_DIR: args.lost_retention_days,
+        },
+        startup_scan=args.startup_scan,
+        scan_workers=args.scan_workers,
+        slow_request_threshold=args.slow_request_threshold,
+        slow_request_log=args.slow_request_log,
+        profile_dir=args.profile_dir,
+        admin_users=args.admin_users,
+        signal_profile_header=TP4_utils.message_header[args.profile_header],
+        signal_profile_count=args.profile_count,
+        host=args.host,
+        port=args.port,
+        cluster_config=cluster_config,
+        node_name=args.node
+    ).run()
 
 
 if __name__ == "__main__":
@@ -5,14 +5,51 @@ des statistiques.
 """
 import enum
 import os
-from typing import Any, TypedDict
+from typing import Any, Optional, TypedDict
 
 SOCKET_PORT = 5322
 SERVER_DATA_DIR = f"server_data{os.sep}"
 SERVER_LOST_DIR = f"LOST{os.sep}"
+SERVER_QUARANTINE_DIR = f"QUARANTINE{os.sep}"
+PROFILE_DIR = f"profiles{os.sep}"
+SERVER_OUTBOX_DIR = f"OUTBOX{os.sep}"
 SERVER_DOMAIN = "glo-2000.ca"
 SMTP_SERVER = "smtp.ulaval.ca"
 
+# Fichier d’état (pierres tombales, drapeaux, dossiers) d’une boîte de courriels
+MAILBOX_STATE_FILE = ".state.json"
+PASSWORD_FILE = "passwd"
+DEFAULT_FOLDER = "INBOX"
+# Nombre de changements conservés pour la synchronisation incrémentale
+MAILBOX_CHANGELOG_SIZE = 500
+
+# Intervalle (en secondes) entre deux passes de compactage en arrière-plan
+COMPACTION_INTERVAL = 300
+# Politiques de rétention : nombre de jours avant l’expiration des courriels
+# de chaque dossier racine (None pour les conserver indéfiniment).
+RETENTION_DAYS: dict[str, Optional[int]] = {
+    SERVER_DATA_DIR: None,
+    SERVER_LOST_DIR: 30,
+}
+
+# Taille maximale (en octets) des messages en attente d’envoi vers un socket.
+# Au-delà, le serveur déconnecte l’abonné qui ne lit pas ses notifications et
+# le mandataire cesse de lire l’autre extrémité de la session.
+OUTGOING_BUFFER_LIMIT = 1024 * 1024
+
+# Durée (en secondes) à partir de laquelle une requête est journalisée
+SLOW_REQUEST_THRESHOLD = 0.5
+
+# Positions de chaque nœud sur l’anneau de hachage de la grappe
+CLUSTER_VNODES = 64
+# Intervalle (en secondes) entre deux tentatives de transfert vers un nœud
+CLUSTER_RETRY_INTERVAL = 5
+# Délai (en secondes) accordé à un nœud pour répondre à une requête de grappe
+CLUSTER_REQUEST_TIMEOUT = 10
+# Intervalle (en secondes) entre deux consultations de la progression du
+# rééquilibrage d’un nœud
+CLUSTER_REBALANCE_POLL_INTERVAL = 1
+
 CLIENT_AUTH_CHOICE = """1. Créer un compte
 2. Se connecter"""
 CLIENT_USE_CHOICE = """Menu principal
@@ -22,6 +59,16 @@ CLIENT_USE_CHOICE = """Menu principal
 4. Quitter"""
 
 SUBJECT_DISPLAY = "n°{number} {subject} - {source}"
+UNREAD_MARKER = " (non lu)"
+STALE_EPOCH_ERROR = "Les courriels ont été renumérotés, consultez de nouveau la liste."
+UNKNOWN_DESTINATION_ERROR = "L'adresse de destination n'existe pas"
+MIGRATING_ERROR = "Ce compte est en cours de transfert, réessayez dans un instant."
+NEW_EMAIL_DISPLAY = "\nNouveau courriel : " + SUBJECT_DISPLAY
+
+CLIENT_EMAIL_ACTION_CHOICE = """1. Supprimer
+2. Marquer comme non lu
+3. Déplacer vers un dossier
+4. Retour"""
 
 EMAIL_DISPLAY = """De : {source}
 À : {destination}
@@ -33,6 +80,8 @@ Sujet : {subject}
 STATS_DISPLAY = """Nombre de messages : {count}
 Taille du dossier : {size} octets"""
 
+SLOW_REQUEST_DISPLAY = "Requête lente : {header} utilisateur={username} durée={duration:.1f} ms ({phases})"
+
 
 class message_header(enum.IntEnum):
     """
@@ -51,6 +100,23 @@ class message_header(enum.IntEnum):
 
     STATS_REQUEST = enum.auto()
 
+    EMAIL_DELETE = enum.auto()
+    EMAIL_MARK_READ = enum.auto()
+    EMAIL_MARK_UNREAD = enum.auto()
+    EMAIL_MOVE = enum.auto()
+
+    PROFILE_REQUEST = enum.auto()
+
+    INBOX_SUBSCRIBE = enum.auto()
+    INBOX_UNSUBSCRIBE = enum.auto()
+    NEW_EMAIL_NOTIFICATION = enum.auto()
+
+    INBOX_SYNC_REQUEST = enum.auto()
+
+    CLUSTER_DELIVERY = enum.auto()
+    CLUSTER_IMPORT_USER = enum.auto()
+    CLUSTER_REBALANCE = enum.auto()
+
 
 class GLO_message(TypedDict, total=True):
     """
@@ -24,13 +24,37 @@ def _recvall(source: socket.socket, taille: int) -> Union[bytes, None]:
     return msg
 
 
+def encode_msg(message: str) -> bytes:
+    """ 
+    Encode le message, précédé de sa taille, tel qu’il est transmis.
+    """
+    donnee = message.encode(encoding='utf-8')
+    return struct.pack(">I", len(donnee)) + donnee
+
+
+def decode_msgs(buffer: bytearray) -> list[str]:
+    """ 
+    Retire du tampon les messages complets reçus et les retourne décodés.
+    Un message incomplet reste dans le tampon jusqu’à la suite de sa
+    réception.
+    """
+    messages = []
+    while len(buffer) >= 4:
+        taille = struct.unpack(">I", buffer[:4])[0]
+        if len(buffer) < 4 + taille:
+            break
+        messages.append(bytes(buffer[4:4 + taille]).decode(encoding='utf-8'))
+        del buffer[:4 + taille]
+    return messages
+
+
 def send_msg(destination: socket.socket, message: str) -> None:
     """ 
     Encode le message puis le transmet à la destination.
     """
-    donnee = message.encode(encoding='utf-8')
-    destination.sendall(struct.pack(">I", len(donnee)))
-    destination.sendall(donnee)
+    # Un seul envoi pour la taille et le contenu : deux petits envois
+    # successifs subissent le délai de l’algorithme de Nagle.
+    destination.sendall(encode_msg(message))
 
 
 def recv_msg(source: socket.socket) -> Optional[str]: